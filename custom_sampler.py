@@ -1,6 +1,5 @@
 
 from torch.utils.data import Sampler, SequentialSampler, RandomSampler
-from torch._six import int_classes as _int_classes
 import numpy as np
 
 class CustomSampler(Sampler):
@@ -16,6 +15,10 @@ class CustomSampler(Sampler):
             its size would be less than ``batch_size``
         ws_range (List): The range in which the window size will be randomly sampled. 
         [low, high) -> low - inclusive, high - exclusive
+        seed (int, optional): Seed for the window sizes, by default the global numpy
+            random state is used.
+        deterministic (bool): If ``True``, the window sizes are drawn again from ``seed``
+            every epoch, so every epoch yields the same batches for a sequential sampler.
 
 
     Example:
@@ -23,9 +26,9 @@ class CustomSampler(Sampler):
         [[(0, 20), (1, 20), (2, 20)], [(3, 16), (4, 16), (5, 16)], [(6, 29), (7, 29), (8, 29)], [(9, 18)]]
     """
 
-    def __init__(self, sampler, batch_size, drop_last=False, ws_range=[16,32]):
+    def __init__(self, sampler, batch_size, drop_last=False, ws_range=[16,32], seed=None, deterministic=False):
         # Validate input variables
-        if not isinstance(batch_size, _int_classes) or isinstance(batch_size, bool) or \
+        if not isinstance(batch_size, int) or isinstance(batch_size, bool) or \
                 batch_size <= 0:
             raise ValueError("batch_size should be a positive integer value, "
                              "but got batch_size={}".format(batch_size))
@@ -38,19 +41,24 @@ class CustomSampler(Sampler):
         self.batch_size = batch_size
         self.drop_last = drop_last
         self.ws_range = ws_range
+        self.seed = seed
+        self.deterministic = deterministic
+        self.random_state = np.random if seed is None else np.random.RandomState(seed)
 
     def __iter__(self):
+        if self.deterministic:
+            self.random_state = np.random.RandomState(self.seed)
         batch = []
         for idx in self.sampler:
             batch.append(idx)
             if len(batch) == self.batch_size:
-                window_size = np.random.randint(*self.ws_range)
+                window_size = self.random_state.randint(*self.ws_range)
                 batch = [(x, window_size) for x in batch]
                 yield batch
                 batch = []
 
         if len(batch) > 0 and not self.drop_last:
-            window_size = np.random.randint(*self.ws_range)
+            window_size = self.random_state.randint(*self.ws_range)
             batch = [(x, window_size) for x in batch]
             yield batch
 
@@ -59,9 +67,97 @@ class CustomSampler(Sampler):
             return len(self.sampler) // self.batch_size
         return (len(self.sampler) + self.batch_size - 1) // self.batch_size
 
+class BucketBatchSampler(Sampler):
+    """Groups the indices by window size, so batches have a single window size and need no padding
+
+    Every index draws its own window size from ws_range like ``PaddedRelayKitchen`` does, indices
+    are collected in one bucket per window size and a bucket is yielded when it is full.
+    Batches are lists of (idx, window_size) as in ``CustomSampler``.
+
+    Args:
+        sampler (Sampler or Iterable): Base sampler. Can be any iterable object
+            with ``__len__`` implemented.
+        batch_size (int): Size of mini-batch.
+        drop_last (bool): If ``True``, the sampler will drop the last, not full,
+            batch of every bucket
+        ws_range (List): The range in which the window size will be randomly sampled. 
+        [low, high) -> low - inclusive, high - exclusive
+        seed (int, optional): Seed for the window sizes. Epochs are reproducible if the
+            base sampler is seeded as well.
+        deterministic (bool): If ``True``, the window sizes are drawn again from ``seed``
+            every epoch, so every epoch yields the same batches for a sequential sampler.
+
+    Attributes:
+        batch_tokens (List): Number of frames of every batch of the current epoch
+        padded_tokens (List): Number of frames of the same batches padded to ws_range[1]
+    """
+
+    def __init__(self, sampler, batch_size, drop_last=False, ws_range=[16,32], seed=None, deterministic=False):
+        # Validate input variables
+        if not isinstance(batch_size, int) or isinstance(batch_size, bool) or \
+                batch_size <= 0:
+            raise ValueError("batch_size should be a positive integer value, "
+                             "but got batch_size={}".format(batch_size))
+        if not isinstance(drop_last, bool):
+            raise ValueError("drop_last should be a boolean value, but got "
+                             "drop_last={}".format(drop_last))
+        assert len(ws_range) == 2
+
+        self.sampler = sampler
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.ws_range = ws_range
+        self.seed = seed
+        self.deterministic = deterministic
+        self.random_state = np.random.RandomState(seed)
+        self.batches = None # Batches of the current epoch, or of the next one if built by __len__
+        self.consumed = False # True once __iter__ started yielding self.batches
+        self.batch_tokens, self.padded_tokens = [], []
+
+    def build_batches(self):
+        if self.deterministic:
+            self.random_state = np.random.RandomState(self.seed)
+        window_sizes = self.random_state.randint(*self.ws_range, size=len(self.sampler))
+        batches, buckets = [], {}
+        for idx, window_size in zip(self.sampler, window_sizes):
+            window_size = int(window_size)
+            bucket = buckets.setdefault(window_size, [])
+            bucket.append(idx)
+            if len(bucket) == self.batch_size:
+                batches.append([(x, window_size) for x in bucket])
+                buckets[window_size] = []
+
+        if not self.drop_last:
+            for window_size, bucket in buckets.items():
+                if len(bucket) > 0:
+                    batches.append([(x, window_size) for x in bucket])
+        self.batches, self.consumed = batches, False
+        self.batch_tokens = [len(batch) * batch[0][1] for batch in batches]
+        self.padded_tokens = [len(batch) * self.ws_range[1] for batch in batches]
+
+    def __iter__(self):
+        if self.batches is None or self.consumed:
+            self.build_batches()
+        self.consumed = True
+        batches = self.batches
+        for batch in batches:
+            yield batch
+        if self.batches is batches:
+            self.batches = None # the next __len__ builds the next epoch
+
+    def __len__(self):
+        # Length of the epoch being iterated, __len__ before __iter__ builds the batches ahead
+        if self.batches is None:
+            self.build_batches()
+        return len(self.batches)
+
 if __name__ == "__main__":
     test = list(CustomSampler(SequentialSampler(range(10)), batch_size=3, drop_last=False, ws_range=[16,32]))
     print(test)
 
     for batch in CustomSampler(RandomSampler(range(10)), batch_size=3, drop_last=False, ws_range=[16,32]):
-        print(batch)
\ No newline at end of file
+        print(batch)
+
+    sampler = BucketBatchSampler(RandomSampler(range(1000)), batch_size=32, drop_last=False, ws_range=[16,32], seed=0)
+    print("Batches:", len(sampler), len(list(sampler)))
+    print("Effective frames: %d, padded frames: %d" % (sum(sampler.batch_tokens), sum(sampler.padded_tokens)))
@@ -20,50 +20,42 @@ sys.path.append("./puppet/vive/source/")
 
 import click
 import glob
+import hashlib
+import json
+import os
 import pickle
 import numpy as np
 from parse_mjl import parse_mjl_logs, viz_parsed_mjl_logs
 from mjrl.utils.gym_env import GymEnv
 import adept_envs
 import time as timer
-import skvideo.io
 import gym
-import cv2
 from pathlib import Path
-
-# headless renderer
-render_buffer = []  # rendering buffer
-
-
-def viewer(env,
-           mode='initialize',
-           filename='video',
-           frame_size=(640, 480),
-           camera_id=0,
-           render=None):
-    if render == 'onscreen':
-        env.mj_render()
-
-    elif render == 'offscreen':
-
-        global render_buffer
-        if mode == 'initialize':
-            render_buffer = []
-            mode = 'render'
-
-        if mode == 'render':
-            curr_frame = env.render(mode='rgb_array')
-            render_buffer.append(curr_frame)
-
-        if mode == 'save':
-            skvideo.io.vwrite(filename, np.asarray(render_buffer))
-            print("\noffscreen buffer saved", filename)
-
-    elif render == 'None':
-        pass
-
-    else:
-        print("unknown render: ", render)
+from multiprocessing import Pool
+sys.path.insert(0, str(Path(__file__).parents[1]))
+from utils.rendering import FrameRenderer, VideoRecorder
+
+# onscreen or headless renderer, offscreen frames are streamed to the video file
+class Viewer():
+    def __init__(self, env, filename='video', render=None):
+        self.env = env
+        self.render_mode = render
+        self.recorder = None
+        if render == 'offscreen':
+            self.recorder = VideoRecorder(filename, outputdict={})
+        elif render not in ['onscreen', 'None']:
+            print("unknown render: ", render)
+
+    def render(self):
+        if self.render_mode == 'onscreen':
+            self.env.mj_render()
+        elif self.recorder is not None:
+            self.recorder.add_frame(self.env.render(mode='rgb_array'))
+
+    def close(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            print("\noffscreen buffer saved", self.recorder.filename)
 
 
 # view demos (physics ignored)
@@ -73,16 +65,16 @@ def render_demos(env, data, filename='demo_rendering.mp4', render=None):
         (FPS * env.sim.model.opt.timestep * env.frame_skip)))
     t0 = timer.time()
 
-    viewer(env, mode='initialize', render=render)
+    viewer = Viewer(env, filename=filename, render=render)
     for i_frame in range(data['ctrl'].shape[0]):
         env.sim.data.qpos[:] = data['qpos'][i_frame].copy()
         env.sim.data.qvel[:] = data['qvel'][i_frame].copy()
         env.sim.forward()
         if i_frame % render_skip == 0:
-            viewer(env, mode='render', render=render)
+            viewer.render()
             print(i_frame, end=', ', flush=True)
 
-    viewer(env, mode='save', filename=filename, render=render)
+    viewer.close()
     print("time taken = %f" % (timer.time() - t0))
 
 
@@ -105,38 +97,35 @@ def gather_training_data(env, data, filename='demo_playback.mp4', render=None):
     env.sim.data.qpos[:] = init_qpos
     env.sim.data.qvel[:] = init_qvel
     env.sim.forward()
-    viewer(env, mode='initialize', render=render)
+    viewer = Viewer(env, filename=filename, render=render)
+    renderer = FrameRenderer(env) # 300x300 offscreen, no 1920x2560 render and resize
 
     # step the env and gather data
-    path_obs = None
-    for i_frame in range(data['ctrl'].shape[0] - 1):
+    # buffers are allocated once with the length of the log and filled in place,
+    # a log with a single step gives empty arrays
+    n_frames = data['ctrl'].shape[0] - 1
+    obs = env._get_obs()
+    path_obs = np.empty((n_frames,) + obs.shape, dtype=obs.dtype)
+    path_act = np.empty((n_frames,) + act_mid.shape, dtype=np.result_type(data['ctrl'], obs, act_mid, act_rng))
+    path_img = np.empty((n_frames,) + renderer.frame.shape, dtype=renderer.frame.dtype)
+    for i_frame in range(n_frames):
         obs = env._get_obs()
-        img = env.render(mode='rgb_array') # 1920, 2560, 3
-        img = cv2.resize(img, (300, 300))
-        if i_frame % 20 == 0:
-            cv2.imwrite("./images/img_" + str(i_frame) + ".png", img) 
-        img = np.expand_dims(img, 0)
+        img = renderer.render() # 300, 300, 3
         ctrl = (data['ctrl'][i_frame] - obs[:9])/(env.skip*env.model.opt.timestep)
         act = (ctrl - act_mid) / act_rng
         act = np.clip(act, -0.999, 0.999)
         next_obs, reward, done, env_info = env.step(act)
-        if path_obs is None:
-            path_obs = obs
-            path_act = act
-            path_img = img
-        else:
-            path_obs = np.vstack((path_obs, obs))
-            path_act = np.vstack((path_act, act))
-            path_img = np.vstack((path_img, img))
+        path_obs[i_frame] = obs
+        path_act[i_frame] = act
+        path_img[i_frame] = img
 
         # render when needed to maintain FPS
         if i_frame % render_skip == 0:
-            viewer(env, mode='render', render=render)
+            viewer.render()
             print(i_frame, end=', ', flush=True)
 
     # finalize
-    if render:
-        viewer(env, mode='save', filename=filename, render=render)
+    viewer.close()
 
     t1 = timer.time()
     print("time taken = %f" % (t1 - t0))
@@ -145,6 +134,93 @@ def gather_training_data(env, data, filename='demo_playback.mp4', render=None):
     return path_obs, path_img, path_act, init_qpos, init_qvel
 
 
+# PARALLEL CONVERSION ==========================================
+worker_env = None  # one env per worker process
+
+
+def init_worker(env_name):
+    global worker_env
+    worker_env = gym.make(env_name)
+
+
+def file_hash(file_name):
+    sha1 = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+# write to a temporary file and rename, a crash never leaves a partial output
+def atomic_dump(obj, file_name):
+    tmp_name = file_name + ".tmp"
+    with open(tmp_name, 'wb') as f:
+        pickle.dump(obj, f)
+    os.replace(tmp_name, file_name)
+
+
+def load_manifest(manifest_file):
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            return json.load(f)
+    return {}
+
+
+def save_manifest(manifest, manifest_file):
+    tmp_name = manifest_file + ".tmp"
+    with open(tmp_name, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_name, manifest_file)
+
+
+# process a single log in the worker env, returns the name of the saved path or None
+def convert_log(job):
+    file, out_name, skip, graph, save_logs, view, render, video_file = job
+    print("processing: " + file, end=': ')
+    data = parse_mjl_logs(file, skip)
+    print("log duration %0.2f" % (data['time'][-1] - data['time'][0]))
+
+    # plot logs
+    if (graph):
+        print("plotting: " + file)
+        viz_parsed_mjl_logs(data)
+
+    # save logs
+    if (save_logs):
+        atomic_dump(data, file[:-4] + ".pkl")
+
+    # render logs to video
+    if view == 'render':
+        render_demos(
+            worker_env,
+            data,
+            filename=data['logName'][:-4] + '_demo_render.mp4',
+            render=render)
+        return None
+
+    # playback logs and gather data
+    elif view == 'playback':
+        obs, imgs, act, init_qpos, init_qvel = gather_training_data(worker_env, data,\
+        filename=video_file, render=render)
+        path = {
+            'observations': obs,
+            'images': imgs,
+            'actions': act,
+            'goals': obs,
+            'init_qpos': init_qpos,
+            'init_qvel': init_qvel
+        }
+        atomic_dump(path, out_name)
+        return out_name
+
+
+def run_job(job):
+    try:
+        return job[1], convert_log(job), None
+    except Exception as e:
+        return job[1], None, str(e)
+
+
 # MAIN =========================================================
 @click.command(help="parse tele-op demos")
 @click.option('--env', '-e', type=str, help='gym env name', required=True)
@@ -166,11 +242,16 @@ def gather_training_data(env, data, filename='demo_playback.mp4', render=None):
     '--view', '-v', type=str, help='render/playback', default='render')
 @click.option(
     '--render', '-r', type=str, help='onscreen/offscreen', default='onscreen')
-def main(env, demo_dir, skip, graph, save_logs, view, render):
+@click.option(
+    '--workers',
+    '-w',
+    type=int,
+    help='number of worker processes, one env each',
+    default=os.cpu_count())
+def main(env, demo_dir, skip, graph, save_logs, view, render, workers):
+    if render == 'onscreen':
+        workers = 1  # a single onscreen window
 
-    gym_env = gym.make(env)
-    #paths = []
-    
     #demo_dirs = ["friday_kettle_bottomknob_hinge_slide", "friday_kettle_bottomknob_switch_slide", 
     #    "friday_kettle_switch_hinge_slide", "friday_kettle_topknob_bottomknob_slide", 
     #    "friday_kettle_topknob_switch_slide", "friday_microwave_bottomknob_hinge_slide",
@@ -190,54 +271,34 @@ def main(env, demo_dir, skip, graph, save_logs, view, render):
     Path(video_dir).mkdir(parents=True, exist_ok=True)
     Path(data_dir).mkdir(parents=True, exist_ok=True)
 
+    # manifest of the converted files: output name -> input file, hash and skip
+    manifest_file = data_dir + "manifest.json"
+    manifest = load_manifest(manifest_file)
+
+    # sorted logs, so the output names do not change between runs
+    jobs, sources = [], {}
     for demo_dir in demo_dirs:
         print("Scanning demo_dir: " + demo_dir + "=========")
         comp_demo_dir = "./kitchen_demos_multitask/" + demo_dir + "/"
-        for ind, file in enumerate(glob.glob(comp_demo_dir + "*.mjl")):
-
-            # process logs
-            print("processing: " + file, end=': ')
-
-            data = parse_mjl_logs(file, skip)
-
-            print("log duration %0.2f" % (data['time'][-1] - data['time'][0]))
-
-            # plot logs
-            if (graph):
-                print("plotting: " + file)
-                viz_parsed_mjl_logs(data)
-
-            # save logs
-            if (save_logs):
-                pickle.dump(data, open(file[:-4] + ".pkl", 'wb'))
-
-            # render logs to video
-            if view == 'render':
-                render_demos(
-                    gym_env,
-                    data,
-                    filename=data['logName'][:-4] + '_demo_render.mp4',
-                    render=render)
-
-            # playback logs and gather data
-            elif view == 'playback':
-                try:
-                    obs, imgs, act, init_qpos, init_qvel = gather_training_data(gym_env, data,\
-                    filename=video_dir + demo_dir + "_" + str(ind) + '.mp4', render=render)
-                    #data['logName'][:-4]+'_playback.mp4', render=render)
-                except Exception as e:
-                    print(e)
-                    continue
-                path = {
-                    'observations': obs,
-                    'images': imgs,
-                    'actions': act,
-                    'goals': obs,
-                    'init_qpos': init_qpos,
-                    'init_qvel': init_qvel
-                }
-                #paths.append(path)
-                pickle.dump(path, open(data_dir + demo_dir + "_" + str(ind) + "_path.pkl", 'wb'))
-                #print(demo_dir + env + file + "_path.pkl")
+        for ind, file in enumerate(sorted(glob.glob(comp_demo_dir + "*.mjl"))):
+            out_name = data_dir + demo_dir + "_" + str(ind) + "_path.pkl"
+            source = {'input': file, 'sha1': file_hash(file), 'skip': skip}
+            if view == 'playback' and manifest.get(out_name) == source and os.path.exists(out_name):
+                continue  # already converted
+            sources[out_name] = source
+            video_file = video_dir + demo_dir + "_" + str(ind) + '.mp4'
+            jobs.append((file, out_name, skip, graph, save_logs, view, render, video_file))
+    print("%d logs to process with %d workers" % (len(jobs), workers))
+
+    with Pool(workers, initializer=init_worker, initargs=(env,)) as pool:
+        for i, (out_name, saved, error) in enumerate(pool.imap_unordered(run_job, jobs)):
+            if error is not None:
+                print(out_name, error)
+            elif saved is not None:
+                manifest[out_name] = sources[out_name]
+                save_manifest(manifest, manifest_file)
+            print("done %d/%d" % (i + 1, len(jobs)))
+
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -14,16 +14,21 @@ utils.add_path('/media/suresh/research/github/robotics/rl_robotics/packages/mjrl
 
 import os
 
-import pickle
 import numpy as np
 from parse_mjl import parse_mjl_logs, viz_parsed_mjl_logs
 from mjrl.utils.gym_env import GymEnv
 import adept_envs
 import gym
-import cv2
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).parents[1])) # appended, utils above is not the repo utils
+sys.path.append(str(Path(__file__).parents[1] / "utils")) # repo utils/rendering.py, imported by module name
+from dataset_storage import ChunkedEpisodeWriter
+from rendering import FrameRenderer
 
 # playback demos and get data(physics respected)
-def gather_training_data(env, data, pkl_seq, save_path, width = 300, height = 300, render=None):
+# frames are appended to the chunked episode writer instead of one png per frame
+def gather_training_data(env, data, writer, width = 300, height = 300, render=None):
 
     env = env.env
 
@@ -38,26 +43,14 @@ def gather_training_data(env, data, pkl_seq, save_path, width = 300, height = 30
     env.sim.data.qpos[:] = init_qpos
     env.sim.data.qvel[:] = init_qvel
     env.sim.forward()
+    renderer = FrameRenderer(env, (height, width)) # offscreen at the final size, no full size render and resize
 
     # step the env and gather data
-    img_seq = 0
-    path_obs = None
-    path_img = None
-    path_act = None
-    for i_frame in range(data['ctrl'].shape[0] - 1):
+    n_frames = data['ctrl'].shape[0] - 1
+    for i_frame in range(n_frames):
+        frame = {}
         if render == 'OFF':
-            curr_frame = env.render(mode='rgb_array')
-
-            # resize image and save
-            img_seq += 1
-            img_name = '/images/' + str(pkl_seq).zfill(5) + '_' + str(img_seq).zfill(5) + '.png'
-            curr_frame = cv2.resize(curr_frame, (width, height))
-            cv2.imwrite(save_path+img_name, curr_frame)
-
-            if path_img is None:
-                path_img = np.array([img_name])
-            else:
-                path_img = np.vstack((path_img, np.array([img_name])))
+            frame['images'] = renderer.render() # copied into the chunk buffer by append
         else: # 'ON'
             env.mj_render()
 
@@ -68,22 +61,18 @@ def gather_training_data(env, data, pkl_seq, save_path, width = 300, height = 30
         act = (ctrl - act_mid) / act_rng
         act = np.clip(act, -0.999, 0.999)
         next_obs, reward, done, env_info = env.step(act)
-        if path_obs is None:
-            path_obs = obs
-            path_act = act
-        else:
-            path_obs = np.vstack((path_obs, obs))
-            path_act = np.vstack((path_act, act))
+        writer.append(observations=obs, actions=act, **frame)
 
     # note that <init_qpos, init_qvel> are one step away from <path_obs[0], path_act[0]>
-    return path_obs, path_img, path_act, init_qpos, init_qvel
+    writer.close(init_qpos=init_qpos, init_qvel=init_qvel)
+    return n_frames
 
-def main(env, demo_dir, skip, view, save_path, width, height, render):
-    pkl_dir = save_path+'/pkl/'
-    images_dir = save_path+'/images/'
-    if not os.path.exists(pkl_dir):
-        os.makedirs(pkl_dir)
-        os.makedirs(images_dir)
+# every log is saved as an episode folder in save_path, readable by relay_kitchen_dataset.py
+# render == 'ON' shows the playback without images, the chunked store needs the offscreen images
+def main(env, demo_dir, skip, view, save_path, width, height, render, chunk_size=64, compress=False):
+    assert view != 'playback' or render == 'OFF', "render must be 'OFF' to write images to the chunked store"
+    if not os.path.exists(save_path):
+        os.makedirs(save_path)
 
     pkl_seq = 0
     gym_env = gym.make(env)
@@ -102,25 +91,15 @@ def main(env, demo_dir, skip, view, save_path, width, height, render):
                 continue
 
 
-            # playback logs and gather data
+            # playback logs and save training data
             if view == 'playback':
+                episode_name = env + '_' + str(pkl_seq).zfill(5)
+                writer = ChunkedEpisodeWriter(save_path, episode_name, chunk_size, compress)
                 try:
-                    obs, img, act, init_qpos, init_qvel = gather_training_data(gym_env, data, pkl_seq, save_path, width, height, render)
+                    gather_training_data(gym_env, data, writer, width, height, render)
                 except Exception as e:
                     print(e)
                     continue
-                path = {
-                    'observations': obs,
-                    'images': img,
-                    'actions': act,
-                    'goals': obs,
-                    'init_qpos': init_qpos,
-                    'init_qvel': init_qvel
-                }
-
-            # save traiing data
-            pkl_name = env + '_' + str(pkl_seq).zfill(5) + '.pkl'
-            pickle.dump(path, open(pkl_dir + pkl_name, 'wb'))
             print('done')
         # if pkl_seq == 1: # remove this if-block
         #     break
@@ -136,5 +115,8 @@ if __name__ == '__main__':
     width = 299
     height = 299
 
+    chunk_size = 64
+    compress = False # compressed chunks are smaller but decoded on read
+
     env = 'kitchen_relax-v1'
-    main(env, demo_dir, skip, view, save_path, width, height, render)
+    main(env, demo_dir, skip, view, save_path, width, height, render, chunk_size, compress)
@@ -1,59 +1,146 @@
+import os
 import pytorch_lightning as pl
 import torch
-from torch.utils.data import RandomSampler, DataLoader
-from custom_sampler import CustomSampler
+from torch.utils.data import RandomSampler, SequentialSampler, DataLoader
+from custom_sampler import CustomSampler, BucketBatchSampler
 from relay_kitchen_dataset import VaryingRelayKitchen, PaddedRelayKitchen, ConstantRelayKitchen
 
+#Cpus available to this process, one is left for the training loop
+def default_num_workers(max_workers=8):
+    try:
+        n_cpus = len(os.sched_getaffinity(0))
+    except AttributeError: # not available on Windows and macOS
+        n_cpus = os.cpu_count() or 1
+    return max(0, min(n_cpus - 1, max_workers))
+
+class DevicePrefetcher():
+    """ Iterates a DataLoader with the next batch already being copied to the device.
+        On cuda the copy runs on a side stream while PlayLMP.step uses the current batch,
+        the loader should use pin_memory=True. Window sizes (1d) stay on the host for packing.
+        On cpu the batches are passed through. """
+    def __init__(self, loader, device=None):
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.loader = loader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def to_device(self, batch):
+        with torch.cuda.stream(self.stream):
+            batch = [x.to(self.device, non_blocking=True) if torch.is_tensor(x) and x.dim() > 1 else x
+                     for x in batch]
+            copied = torch.cuda.Event()
+            copied.record(self.stream)
+        return batch, copied
+
+    def wait(self, batch, copied):
+        stream = torch.cuda.current_stream(self.device)
+        stream.wait_event(copied)
+        for x in batch:
+            if torch.is_tensor(x) and x.is_cuda:
+                x.record_stream(stream) #memory was allocated on the side stream
+        return batch
+
+    def __iter__(self):
+        if self.stream is None:
+            yield from self.loader
+            return
+        next_batch = None
+        for batch in self.loader:
+            batch = self.to_device(batch) #starts the copy of the next batch
+            if next_batch is not None:
+                yield self.wait(*next_batch)
+            next_batch = batch
+        if next_batch is not None:
+            yield self.wait(*next_batch)
+
 class RelayKitchenDataModule(pl.LightningDataModule):
+    """ num_workers: dataloader processes, by default the available cpus minus one (max 8)
+        pin_memory: by default if cuda is available
+        persistent_workers, prefetch_factor: only used with num_workers > 0
+        Validation batches are not shuffled, padded, varying and bucketed window sizes
+        are drawn from seed (0 by default) so every validation sees the same batches. """
     def __init__(self, root_data_dir="data", batch_size=16, ws_range=[16,32],  \
-                window_size=32, type="fixed"):
+                window_size=32, type="fixed", lazy=False, cache_size=4, seed=None, \
+                num_workers=None, pin_memory=None, persistent_workers=True, prefetch_factor=2):
         super().__init__()
         self.data_dir = root_data_dir
         self.batch_size = batch_size
         self.window_size = window_size
         self.ws_range = ws_range
+        self.lazy = lazy # Read files on demand, for datasets that do not fit in memory
+        self.cache_size = cache_size
+        self.seed = seed
+        self.num_workers = default_num_workers() if num_workers is None else num_workers
+        self.pin_memory = torch.cuda.is_available() if pin_memory is None else pin_memory
+        self.persistent_workers = persistent_workers
+        self.prefetch_factor = prefetch_factor
 
-        assert type == "fixed" or type == "padded" or type =="varying"
+        assert type == "fixed" or type == "padded" or type =="varying" or type == "bucketed"
         self.type = type
 
     def setup(self, stage=None):
         training_dir = self.data_dir + '/training'
         val_dir = self.data_dir + '/validation'
+        load_args = {'lazy': self.lazy, 'cache_size': self.cache_size}
+        val_seed = 0 if self.seed is None else self.seed
         if self.type == "fixed":
-            self.train_dataset = ConstantRelayKitchen(training_dir, self.window_size)
-            self.val_dataset = ConstantRelayKitchen(val_dir, self.window_size)
+            self.train_dataset = ConstantRelayKitchen(training_dir, self.window_size, **load_args)
+            self.val_dataset = ConstantRelayKitchen(val_dir, self.window_size, **load_args)
         elif self.type == "padded":
-            self.train_dataset = PaddedRelayKitchen(training_dir, ws_range = self.ws_range)
-            self.val_dataset = PaddedRelayKitchen(val_dir, ws_range = self.ws_range)
+            self.train_dataset = PaddedRelayKitchen(training_dir, ws_range = self.ws_range, **load_args)
+            self.val_dataset = PaddedRelayKitchen(val_dir, ws_range = self.ws_range, seed = val_seed, **load_args)
         elif self.type == "varying":
-            self.train_dataset = VaryingRelayKitchen(training_dir, ws_range = self.ws_range)
+            self.train_dataset = VaryingRelayKitchen(training_dir, ws_range = self.ws_range, **load_args)
             self.train_sampler = CustomSampler( sampler = RandomSampler(self.train_dataset),
                                                 batch_size = self.batch_size,
                                                 drop_last = False, ws_range = self.ws_range )
-            self.val_dataset = VaryingRelayKitchen(val_dir, ws_range = self.ws_range)
-            self.val_sampler = CustomSampler( sampler = RandomSampler(self.val_dataset),
-                                              batch_size = self.batch_size,
-                                              drop_last = False, ws_range = self.ws_range )
+            self.val_dataset = VaryingRelayKitchen(val_dir, ws_range = self.ws_range, **load_args)
+            self.val_sampler = CustomSampler( sampler = SequentialSampler(self.val_dataset),
+                                              batch_size = self.batch_size, drop_last = False,
+                                              ws_range = self.ws_range, seed = val_seed, deterministic = True )
+        elif self.type == "bucketed":
+            # Like padded, a window size per sample, but batches are grouped by window size
+            generator = None
+            if self.seed is not None:
+                generator = torch.Generator()
+                generator.manual_seed(self.seed)
+            self.train_dataset = VaryingRelayKitchen(training_dir, ws_range = self.ws_range, **load_args)
+            self.train_sampler = BucketBatchSampler( sampler = RandomSampler(self.train_dataset, generator=generator),
+                                                     batch_size = self.batch_size, drop_last = False,
+                                                     ws_range = self.ws_range, seed = self.seed )
+            self.val_dataset = VaryingRelayKitchen(val_dir, ws_range = self.ws_range, **load_args)
+            self.val_sampler = BucketBatchSampler( sampler = SequentialSampler(self.val_dataset),
+                                                   batch_size = self.batch_size, drop_last = False,
+                                                   ws_range = self.ws_range, seed = val_seed, deterministic = True )
         else:
             raise Exception("Invalid type for Dataloader")
 
+    def loader_args(self):
+        args = {'num_workers': self.num_workers, 'pin_memory': self.pin_memory}
+        if self.num_workers > 0:
+            args['persistent_workers'] = self.persistent_workers
+            args['prefetch_factor'] = self.prefetch_factor
+        return args
+
     def train_dataloader(self):
-        if self.type == "varying":
-            return DataLoader(self.train_dataset, batch_sampler=self.train_sampler, num_workers=4,
-                            pin_memory=True)
+        if self.type == "varying" or self.type == "bucketed":
+            return DataLoader(self.train_dataset, batch_sampler=self.train_sampler, **self.loader_args())
         return DataLoader(self.train_dataset, batch_size=self.batch_size, shuffle=True, 
-                              num_workers=4, pin_memory=True)
+                              **self.loader_args())
 
     def val_dataloader(self):
-        if self.type == "varying":
-            return DataLoader(self.val_dataset, batch_sampler=self.val_sampler, num_workers=4,
-                            pin_memory=True)
-        return DataLoader(self.val_dataset, batch_size=self.batch_size, shuffle=True, 
-                              num_workers=4, pin_memory=True)
+        if self.type == "varying" or self.type == "bucketed":
+            return DataLoader(self.val_dataset, batch_sampler=self.val_sampler, **self.loader_args())
+        return DataLoader(self.val_dataset, batch_size=self.batch_size, shuffle=False, 
+                              **self.loader_args())
 
 if __name__ == "__main__":
     # Test all dataloader types
-    types = ["fixed", "padded", "varying"]
+    types = ["fixed", "padded", "varying", "bucketed"]
     for type in types:
         print("Testing type: %s" % type)
         module = RelayKitchenDataModule(type=type)
@@ -66,5 +153,5 @@ if __name__ == "__main__":
             print(seq_obs.shape)
 
         print("Training")
-        for seq_obs, seq_imgs, seq_acts in train_loader:
-            print(seq_obs.shape)
\ No newline at end of file
+        for batch in train_loader: # Padded batches also include the window sizes
+            print(batch[0].shape)
\ No newline at end of file
@@ -0,0 +1,239 @@
+import argparse
+import glob
+import json
+import os
+import pickle
+import numpy as np
+from collections import OrderedDict
+
+KEYS = ['observations', 'images', 'actions']
+OFFSETS_FILE = "offsets.npy"
+META_FILE = "meta.json"
+EPISODE_META_FILE = "episode.json"
+
+#Check if a folder was already converted with convert_to_memmap
+def is_memmap_dir(datasets_dir):
+    return os.path.isfile(os.path.join(datasets_dir, OFFSETS_FILE))
+
+#Write every *.pkl path in datasets_dir as one contiguous raw array per key,
+#offsets[i]:offsets[i+1] are the frames of the i-th path
+def convert_to_memmap(datasets_dir, output_dir=None):
+    output_dir = datasets_dir if output_dir is None else output_dir
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    file_names = sorted(glob.glob(os.path.join(datasets_dir, "*.pkl")))
+    meta = {'files': []}
+    offsets = [0]
+    raw_files = {key: open(os.path.join(output_dir, key + ".dat"), 'wb') for key in KEYS}
+    try:
+        for data_file in file_names:
+            if os.path.getsize(data_file) == 0: #Skip empty files
+                continue
+            with open(data_file, 'rb') as f:
+                data = pickle.load(f)
+            for key in KEYS:
+                array = data[key][:, :9] if key == "observations" else data[key]
+                if key not in meta:
+                    meta[key] = {'dtype': np.asarray(array).dtype.str, 'shape': list(array.shape[1:])}
+                array = np.ascontiguousarray(array, dtype=np.dtype(meta[key]['dtype']))
+                assert list(array.shape[1:]) == meta[key]['shape']
+                raw_files[key].write(array.tobytes())
+            offsets.append(offsets[-1] + data['observations'].shape[0])
+            meta['files'].append(os.path.basename(data_file))
+            print("Converted %s" % os.path.basename(data_file))
+    finally:
+        for raw_file in raw_files.values():
+            raw_file.close()
+    #Offsets are written last, an interrupted conversion is not detected as a memmap dir
+    with open(os.path.join(output_dir, META_FILE), 'w') as f:
+        json.dump(meta, f)
+    np.save(os.path.join(output_dir, OFFSETS_FILE), np.array(offsets, dtype=np.int64))
+
+#Same list of paths as preprocessing.load_data, every array is a view of a read-only memmap
+#so forked dataloader workers share the page cache instead of private copies
+def load_memmap_paths(datasets_dir):
+    offsets = np.load(os.path.join(datasets_dir, OFFSETS_FILE))
+    with open(os.path.join(datasets_dir, META_FILE), 'r') as f:
+        meta = json.load(f)
+    n_frames = int(offsets[-1])
+    arrays = {}
+    for key in KEYS:
+        shape = (n_frames,) + tuple(meta[key]['shape'])
+        arrays[key] = np.memmap(os.path.join(datasets_dir, key + ".dat"),
+                                dtype=np.dtype(meta[key]['dtype']), mode='r', shape=shape)
+    paths = []
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        paths.append({key: arrays[key][start:end] for key in KEYS})
+    return paths
+
+#Check if a folder has episodes written with ChunkedEpisodeWriter
+def is_chunked_dir(datasets_dir):
+    return len(glob.glob(os.path.join(datasets_dir, "*", EPISODE_META_FILE))) > 0
+
+def chunk_name(key, chunk_idx, compress):
+    return "%s_%05d.%s" % (key, chunk_idx, "npz" if compress else "npy")
+
+class ChunkedEpisodeWriter():
+    """ Appends the frames of one episode to fixed size chunks, output_dir/episode_name/<key>_<chunk>.npy
+        (.npz if compressed). Frames are copied to a preallocated chunk buffer that is written when full.
+        The episode meta is written by close, so an interrupted episode is not read """
+    def __init__(self, output_dir, episode_name, chunk_size=64, compress=False):
+        self.episode_dir = os.path.join(output_dir, episode_name)
+        if not os.path.exists(self.episode_dir):
+            os.makedirs(self.episode_dir)
+        self.chunk_size = chunk_size
+        self.compress = compress
+        self.buffers = None
+        self.length = 0
+        self.n_chunks = 0
+
+    #One frame per key, e.g append(observations=obs, images=img, actions=act)
+    def append(self, **frame):
+        if self.buffers is None:
+            self.buffers = {key: np.empty((self.chunk_size,) + np.shape(value), dtype=np.asarray(value).dtype)
+                            for key, value in frame.items()}
+        for key, value in frame.items():
+            self.buffers[key][self.length % self.chunk_size] = value
+        self.length += 1
+        if self.length % self.chunk_size == 0:
+            self.flush(self.chunk_size)
+
+    def flush(self, n_frames):
+        for key, buffer in self.buffers.items():
+            file_name = os.path.join(self.episode_dir, chunk_name(key, self.n_chunks, self.compress))
+            if self.compress:
+                np.savez_compressed(file_name, data=buffer[:n_frames])
+            else:
+                np.save(file_name, buffer[:n_frames])
+        self.n_chunks += 1
+
+    #attrs: small per episode values stored in the meta, e.g. init_qpos
+    def close(self, **attrs):
+        if self.length % self.chunk_size > 0:
+            self.flush(self.length % self.chunk_size)
+        meta = {'length': self.length, 'chunk_size': self.chunk_size, 'compress': self.compress,
+                'keys': {key: {'dtype': buffer.dtype.str, 'shape': list(buffer.shape[1:])}
+                         for key, buffer in (self.buffers or {}).items()},
+                'attrs': {key: np.asarray(value).tolist() for key, value in attrs.items()}}
+        with open(os.path.join(self.episode_dir, EPISODE_META_FILE), 'w') as f:
+            json.dump(meta, f)
+
+class ChunkCache():
+    """ LRU of the last cache_size loaded chunks of all the episodes of a dataset, keyed by
+        (episode_dir, key, chunk idx). One cache is shared by every ChunkedArray of load_chunked_paths,
+        so the open memmaps (one file descriptor each) and decoded chunks do not grow with the episodes.
+        Forked dataloader workers get their own copy """
+    def __init__(self, cache_size=16):
+        self.cache_size = cache_size
+        self.chunks = OrderedDict()  # (episode_dir, key, chunk idx) -> array, most recently used last
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def get(self, chunk_id, load_fn):
+        if chunk_id in self.chunks:
+            self.chunks.move_to_end(chunk_id)
+            return self.chunks[chunk_id]
+        chunk = load_fn()
+        self.chunks[chunk_id] = chunk
+        if len(self.chunks) > self.cache_size:
+            self.chunks.popitem(last=False)
+        return chunk
+
+class ChunkedArray():
+    """ Read only array of one key of an episode. Slicing the frames only reads the chunks in the slice,
+        a window shorter than chunk_size reads one or two chunks. Uncompressed chunks are memory-mapped,
+        loaded chunks are kept in cache, a ChunkCache that can be shared with the arrays of other episodes.
+        columns selects part of the last dimension """
+    def __init__(self, episode_dir, key, meta, columns=None, cache=None):
+        self.episode_dir = episode_dir
+        self.key = key
+        self.length = meta['length']
+        self.chunk_size = meta['chunk_size']
+        self.compress = meta['compress']
+        self.dtype = np.dtype(meta['keys'][key]['dtype'])
+        self.shape = (self.length,) + tuple(meta['keys'][key]['shape'])
+        self.columns = columns
+        if columns is not None:
+            self.shape = self.shape[:-1] + (len(range(*columns.indices(self.shape[-1]))),)
+        self.cache = ChunkCache(2) if cache is None else cache
+
+    def __len__(self):
+        return self.length
+
+    def load_chunk(self, chunk_idx):
+        return self.cache.get((self.episode_dir, self.key, chunk_idx), lambda: self.read_chunk(chunk_idx))
+
+    def read_chunk(self, chunk_idx):
+        file_name = os.path.join(self.episode_dir, chunk_name(self.key, chunk_idx, self.compress))
+        if self.compress:
+            with np.load(file_name) as f:
+                chunk = f['data']
+        else:
+            chunk = np.load(file_name, mmap_mode='r')
+        if self.columns is not None:
+            chunk = chunk[..., self.columns]
+        return chunk
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(self.length)
+            assert step == 1, "only contiguous slices are supported"
+            if stop <= start:
+                return np.empty((0,) + self.shape[1:], dtype=self.dtype)
+            first, last = start // self.chunk_size, (stop - 1) // self.chunk_size
+            parts = []
+            for chunk_idx in range(first, last + 1):
+                offset = chunk_idx * self.chunk_size
+                parts.append(self.load_chunk(chunk_idx)[max(start - offset, 0): stop - offset])
+            return np.concatenate(parts) if len(parts) > 1 else np.array(parts[0])
+        idx = int(idx)
+        if idx < 0:
+            idx += self.length
+        if not 0 <= idx < self.length:
+            raise IndexError("index %d out of range for %d frames" % (idx, self.length))
+        return np.array(self.load_chunk(idx // self.chunk_size)[idx % self.chunk_size])
+
+#Same list of paths as preprocessing.load_data, arrays are ChunkedArray read on demand.
+#All the arrays share one ChunkCache of cache_size chunks, a window reads up to two chunks per key
+def load_chunked_paths(datasets_dir, cache_size=16):
+    cache = ChunkCache(cache_size)
+    paths = []
+    for meta_file in sorted(glob.glob(os.path.join(datasets_dir, "*", EPISODE_META_FILE))):
+        with open(meta_file, 'r') as f:
+            meta = json.load(f)
+        episode_dir = os.path.dirname(meta_file)
+        missing = [key for key in KEYS if key not in meta['keys']]
+        if missing:
+            raise ValueError("episode %s has no %s, it was written without them (e.g. collected with render 'ON')" \
+                             % (episode_dir, ", ".join(missing)))
+        paths.append({key: ChunkedArray(episode_dir, key, meta, slice(0, 9) if key == "observations" else None,
+                                        cache) for key in KEYS})
+    return paths
+
+#Write every *.pkl path in datasets_dir as a chunked episode
+def convert_to_chunked(datasets_dir, output_dir=None, chunk_size=64, compress=False):
+    output_dir = datasets_dir if output_dir is None else output_dir
+    for data_file in sorted(glob.glob(os.path.join(datasets_dir, "*.pkl"))):
+        if os.path.getsize(data_file) == 0: #Skip empty files
+            continue
+        with open(data_file, 'rb') as f:
+            data = pickle.load(f)
+        writer = ChunkedEpisodeWriter(output_dir, os.path.basename(data_file)[:-4], chunk_size, compress)
+        for frame in zip(*[data[key] for key in KEYS]):
+            writer.append(**dict(zip(KEYS, frame)))
+        writer.close(init_qpos=data['init_qpos'], init_qvel=data['init_qvel'])
+        print("Converted %s" % os.path.basename(data_file))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert *.pkl paths to memory-mapped or chunked arrays')
+    parser.add_argument('--datasets_dirs', nargs='+', default=["./data/training", "./data/validation"])
+    parser.add_argument('--format', type=str, default='memmap', choices=['memmap', 'chunked'])
+    parser.add_argument('--chunk_size', type=int, default=64)
+    parser.add_argument('--compress', action='store_true', help='compressed chunks')
+    args = parser.parse_args()
+    for datasets_dir in args.datasets_dirs:
+        if args.format == 'memmap':
+            convert_to_memmap(datasets_dir)
+        else:
+            convert_to_chunked(datasets_dir, chunk_size=args.chunk_size, compress=args.compress)
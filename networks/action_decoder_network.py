@@ -7,6 +7,7 @@ from pathlib import Path
 from torch.distributions import Categorical
 sys.path.insert(0, str(Path(__file__).parents[1]))
 import utils.constants as constants
+from networks.networks import rnn_forward
 
 class ActionDecoderNetwork(nn.Module):
     def __init__(self, k=constants.N_MIXTURES):
@@ -24,10 +25,16 @@ class ActionDecoderNetwork(nn.Module):
     def sample(self, *args, **kwargs):
         return self.mix_model.sample(*args, **kwargs)
 
-    def forward(self, x):
-        x, _ = self.rnn(x) # b, s, 2048
+    def forward(self, x, lengths=None):
+        x, _ = rnn_forward(self.rnn, x, lengths) # b, s, 2048
         return self.mix_model(x) #pi, sigma, mu
 
+    # Streaming decoding for closed loop control, x = (b, 1, d)
+    # the rnn hidden state is returned to be passed back in the next env step
+    def forward_step(self, x, hidden=None):
+        x, hidden = self.rnn(x, hidden) # b, 1, 2048
+        return self.mix_model(x), hidden
+
 """ Mixture Density Network - Gaussian Mixture Model"""
 class MDN(nn.Module):
 
@@ -52,24 +59,43 @@ class MDN(nn.Module):
         mu = mu.view(batch_size, seq_len, self.num_gaussians, self.out_features) # b, s, k, o
         return pi, sigma, mu
 
-    def loss(self, pi, sigma, mu, target):
-        prob = pi * self.gaussian_probability(sigma, mu, target) #b, s, k
-        nll = -torch.log(torch.sum(prob, dim=-1) + 1e-7) #b, s
-        return torch.mean(nll)
+    # Negative log likelihood computed in log space, log(sum_k pi_k * prod_o N_ko) = logsumexp_k(log pi_k + sum_o log N_ko)
+    def loss(self, pi, sigma, mu, target, mask=None):
+        log_pi = torch.log(pi.clamp_min(torch.finfo(pi.dtype).tiny)) #b, s, k
+        log_prob = log_pi + self.log_gaussian_probability(sigma, mu, target) #b, s, k
+        nll = -torch.logsumexp(log_prob, dim=-1) #b, s
+        if mask is None:
+            return torch.mean(nll)
+        return torch.sum(nll * mask) / torch.sum(mask) # Padded steps are ignored
+
+    def log_gaussian_probability(self, sigma, mu, target):
+        z = (target.unsqueeze(2) - mu) / sigma # target broadcast to b, s, k, o
+        log_prob = -0.5 * z.pow(2) - torch.log(sigma)
+        return log_prob.sum(-1) - 0.5 * self.out_features * math.log(2*math.pi) # b, s, k
 
+    # Density in probability space, the previous loss. It underflows for many dimensions
     def gaussian_probability(self, sigma, mu, target):
         norm_term = 1.0 / math.sqrt(2*math.pi)
         data = target.unsqueeze(2).expand_as(sigma) #b, s, k, o
         ret = norm_term * torch.exp(-0.5 * ((data - mu) / sigma)**2) / sigma
         return torch.prod(ret, -1) # b, s, k
 
-    def sample(self, pi, sigma, mu):
-        sel_gaussians = torch.multinomial(pi.view(-1, pi.shape[-1]), 1)
-        sel_gaussians = sel_gaussians.view(mu.shape[0], mu.shape[1], 1, 1).expand(
-                        -1, -1, -1, self.out_features) #b, s, 1, o
-        sel_mu = torch.gather(mu, 2, sel_gaussians).squeeze() #b, s, o
-        sel_sigma = torch.gather(sigma, 2, sel_gaussians).squeeze() #b, s, o
-        sample = torch.normal(sel_mu, sel_sigma) #b, s, o
+    # n_samples: K samples per state in one call -> K, b, s, o
+    # deterministic: mean of the mixture instead of a sample
+    def sample(self, pi, sigma, mu, n_samples=None, deterministic=False):
+        if deterministic:
+            return torch.sum(pi.unsqueeze(-1) * mu, dim=2) #b, s, o
+        b, s, k = pi.shape
+        n = 1 if n_samples is None else n_samples
+        sel_gaussians = torch.multinomial(pi.reshape(-1, k), n, replacement=True)
+        sel_gaussians = sel_gaussians.view(b, s, n, 1).expand(-1, -1, -1, self.out_features) #b, s, n, o
+        sel_mu = torch.gather(mu, 2, sel_gaussians) #b, s, n, o
+        sel_sigma = torch.gather(sigma, 2, sel_gaussians) #b, s, n, o
+        sample = torch.normal(sel_mu, sel_sigma) #b, s, n, o
+        if n_samples is None:
+            sample = sample.squeeze(2) #b, s, o, batch dims are kept for b = 1 or s = 1
+        else:
+            sample = sample.permute(2, 0, 1, 3) #n, b, s, o
 
         # With reparemeterization trick
         # sample = torch.normal(0, 1, size=sel_mu.shape)
@@ -0,0 +1,99 @@
+import argparse
+import torch
+import torch.nn as nn
+from networks.play_lmp import PlayLMP
+import utils.constants as constants
+
+class PlayLMPInference(nn.Module):
+    """ Inference graph of PlayLMP for rollouts: goal encoding, get_pp_plan and predict_with_plan
+        with a goal encoding, and the stateful decoder step of rollout_step.
+        Images are uint8 (batch, 3, 300, 300), obs are float (batch, 9) """
+    def __init__(self, model):
+        super(PlayLMPInference, self).__init__()
+        self.vision = model.vision
+        self.plan_proposal = model.plan_proposal
+        self.action_decoder = model.action_decoder
+
+    def encode_goal(self, goal_imgs):
+        return self.vision(goal_imgs.float()) #(batch, 64)
+
+    def pp_input(self, obs, imgs, goal_encoding):
+        return torch.cat([self.vision(imgs.float()), obs, goal_encoding], dim=-1) #(batch, 137)
+
+    #get_pp_plan -> plan (batch, 256)
+    def plan(self, obs, imgs, goal_encoding):
+        mu_p, sigma_p = self.plan_proposal(self.pp_input(obs, imgs, goal_encoding))
+        return torch.normal(mu_p, sigma_p)
+
+    #predict_with_plan -> action (batch, 1, 9)
+    def act(self, obs, imgs, goal_encoding, plan):
+        action_input = torch.cat([self.pp_input(obs, imgs, goal_encoding), plan], dim=-1).unsqueeze(1)
+        pi, sigma, mu = self.action_decoder(action_input)
+        return self.action_decoder.sample(pi, sigma, mu)
+
+    #Decoder step carrying the rnn hidden state (2, batch, 2048), zeros start a new plan
+    def act_step(self, obs, imgs, goal_encoding, plan, hidden):
+        action_input = torch.cat([self.pp_input(obs, imgs, goal_encoding), plan], dim=-1).unsqueeze(1)
+        (pi, sigma, mu), hidden = self.action_decoder.forward_step(action_input, hidden)
+        return self.action_decoder.sample(pi, sigma, mu), hidden
+
+    def forward(self, obs, imgs, goal_encoding, plan):
+        return self.act(obs, imgs, goal_encoding, plan)
+
+def example_inputs(batch_size=1, device="cpu"):
+    obs = torch.zeros(batch_size, constants.N_DOF_ROBOT, device=device)
+    imgs = torch.zeros(batch_size, 3, 300, 300, dtype=torch.uint8, device=device)
+    goal_encoding = torch.zeros(batch_size, constants.VISUAL_FEATURES, device=device)
+    plan = torch.zeros(batch_size, constants.PLAN_FEATURES, device=device)
+    hidden = torch.zeros(2, batch_size, 2048, device=device)
+    return obs, imgs, goal_encoding, plan, hidden
+
+#Traces the inference graph for a fixed batch size (shapes are specialized), the traced module
+#is warmed up so the jit optimizations run before the first rollout step
+def trace_inference(model, batch_size=1, n_warmup=3):
+    model.eval_mode()
+    module = PlayLMPInference(model).eval()
+    obs, imgs, goal_encoding, plan, hidden = example_inputs(batch_size, model.device)
+    inputs = {'forward': (obs, imgs, goal_encoding, plan),
+              'encode_goal': (imgs,),
+              'plan': (obs, imgs, goal_encoding),
+              'act': (obs, imgs, goal_encoding, plan),
+              'act_step': (obs, imgs, goal_encoding, plan, hidden)}
+    with torch.no_grad():
+        #sampling is random, the traced graph is not compared with the eager outputs
+        traced = torch.jit.trace_module(module, inputs, check_trace=False)
+        for _ in range(n_warmup):
+            for name, args in inputs.items():
+                getattr(traced, name)(*args)
+    return traced
+
+#Saved module only needs torch: torch.jit.load(file_name)
+def export_inference(model, file_name, batch_size=1):
+    traced = trace_inference(model, batch_size)
+    torch.jit.save(traced, file_name)
+    return traced
+
+#torch.compile alternative, not serializable. Compiled on the first call of every method,
+#sampling uses the inductor rng so a seed does not give the same actions as eager
+def compile_inference(model, mode="reduce-overhead"):
+    model.eval_mode()
+    module = PlayLMPInference(model).eval()
+    for name in ['encode_goal', 'plan', 'act', 'act_step']:
+        setattr(module, name, torch.compile(getattr(module, name), mode=mode))
+    return module
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export the PlayLMP inference graph with TorchScript')
+    parser.add_argument('--model_name', type=str, default="10_logistic_multitask_bestacc_new")
+    parser.add_argument('--n_mixtures', type=int, default=constants.N_MIXTURES)
+    parser.add_argument('--use_logistics', type=int, default=int(constants.USE_LOGISTICS))
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--device', type=str, default=None, help='cuda if available by default')
+    args = parser.parse_args()
+
+    #model needs to be placed on "./models/"
+    model = PlayLMP(num_mixtures=args.n_mixtures, use_logistics=bool(args.use_logistics), device=args.device)
+    model.load('./models/%s.pth' % args.model_name)
+    file_name = './models/%s_inference_b%d.pt' % (args.model_name, args.batch_size)
+    export_inference(model, file_name, args.batch_size)
+    print("Saved", file_name)
@@ -4,24 +4,36 @@ import torch.nn.functional as F
 from torch.autograd import Variable
 import utils.constants as constants
 import numpy as np
+import math
+from networks.networks import rnn_forward
 
-def one_hot_embedding(labels, num_classes):
-    y = torch.eye(num_classes).cuda() 
-    return y[labels] 
+#Log probability of the actions under every logistic distribution, discretized in num_classes bins
+#actions (B, S, A) are broadcast against log_scales and means (B, S, A, N_DIST)
+def logistic_log_probs(log_scales, means, actions, num_classes=256, log_scale_min=-7.0):
+    log_scales = torch.clamp(log_scales, min=log_scale_min)
+    actions = actions.unsqueeze(-1) #(B, S, A, 1)
+    #Approximation of CDF derivative (PDF), the bin edges are the center +- half a bin
+    inv_stdv = torch.exp(-log_scales)
+    mid_in = inv_stdv * (actions - means)
+    half_bin = inv_stdv * (1. / (num_classes - 1))
+    plus_in = mid_in + half_bin
+    min_in = mid_in - half_bin
+    #Probability in the bin, or the log probability in the center of the bin if it is too small
+    cdf_delta = torch.sigmoid(plus_in) - torch.sigmoid(min_in)
+    log_pdf_mid = mid_in - log_scales - 2. * F.softplus(mid_in) - math.log((num_classes - 1) / 2)
+    log_probs = torch.where(cdf_delta > 1e-5, torch.log(torch.clamp(cdf_delta, min=1e-12)), log_pdf_mid)
+    #Corner Cases, log cdf of the bin of 0 and log(1 - cdf) of the bin of 255 (before scaling)
+    #with a single softplus, the masks only have the size of the actions
+    edge_in = torch.where(actions < -0.999, plus_in, -min_in)
+    log_edge = edge_in - F.softplus(edge_in)
+    return torch.where((actions < -0.999) | (actions > 0.999), log_edge, log_probs)
 
-#Smooth approximation to the maximum
-def log_sum_exp(x):
-    axis  = len(x.size()) - 1
-    m, _ = torch.max(x, dim=axis)
-    m2, _ = torch.max(x, dim=axis, keepdims=True)
-    return m + torch.log(torch.sum(torch.exp(x - m2), dim=axis))
-
-def sample_gumbel(shape, eps=1e-20):
-    U = torch.rand(shape).cuda()
+def sample_gumbel(shape, eps=1e-20, device=None):
+    U = torch.rand(shape, device=device)
     return -Variable(torch.log(-torch.log(U + eps) + eps))
 
 def gumbel_softmax_sample(logits, temperature):
-    y = logits + sample_gumbel(logits.size())
+    y = logits + sample_gumbel(logits.size(), device=logits.device)
     return F.softmax(y / temperature, dim=-1)
 
 #Selects which logistic distribution to sample from
@@ -35,9 +47,12 @@ def gumbel_softmax(logits, temperature):
     return (y_hard - y).detach() + y    #[*, n_class] an one-hot vector
 
 class LogisticPolicyNetwork(nn.Module):
-    def __init__(self, n_dist=constants.N_MIXTURES):
+    #compile_loss: torch.compile the log probabilities, the elementwise ops of the loss are fused
+    #in a single kernel that only keeps the inputs for backward. Compiled on the first call
+    def __init__(self, n_dist=constants.N_MIXTURES, compile_loss=False):
         super(LogisticPolicyNetwork, self).__init__()
         self.log_scale_min = -7.0
+        self.log_probs_fn = torch.compile(logistic_log_probs, dynamic=True) if compile_loss else logistic_log_probs
         self.in_features = (constants.VISUAL_FEATURES + constants.N_DOF_ROBOT) + \
                             constants.VISUAL_FEATURES + constants.PLAN_FEATURES
         hidden_size = 2048
@@ -49,63 +64,56 @@ class LogisticPolicyNetwork(nn.Module):
         self.log_scale_fc = nn.Linear(hidden_size, self.out_features * self.n_dist)
         self.prob_fc = nn.Linear(hidden_size, self.out_features * self.n_dist)
 
-    def loss(self, logit_probs, log_scales, means, actions, num_classes=256):
-        #Appropiate scale
-        log_scales = torch.clamp(log_scales, min=self.log_scale_min)
-        #Brodcast actions (B, A, N_DIST)
-        actions = actions.unsqueeze(-1) * torch.ones(1, 1, self.n_dist).cuda()
-        #Approximation of CDF derivative (PDF)
-        centered_actions = actions - means 
-        inv_stdv = torch.exp(-log_scales) 
-        plus_in = inv_stdv * (centered_actions + 1. / (num_classes - 1)) 
-        cdf_plus = torch.sigmoid(plus_in) 
-        min_in = inv_stdv * (centered_actions - 1. / (num_classes - 1)) 
-        cdf_min = torch.sigmoid(min_in) 
-
-        #Corner Cases
-        log_cdf_plus = plus_in -F.softplus(plus_in) # log probability for edge case of 0 (before scaling) 
-        log_one_minus_cdf_min = -F.softplus(min_in) # log probability for edge case of 255 (before scaling) 
-        #Log probability in the center of the bin
-        mid_in = inv_stdv * centered_actions
-        log_pdf_mid = mid_in - log_scales - 2. * F.softplus(mid_in)
-        #Probability for all other cases 
-        cdf_delta = cdf_plus - cdf_min 
-
-        #Log probability
-        log_probs = torch.where(actions < -0.999, log_cdf_plus,
-                        torch.where(actions > 0.999, log_one_minus_cdf_min,
-                            torch.where(cdf_delta > 1e-5,
-                                torch.log(torch.clamp(cdf_delta, min=1e-12)),
-                                    log_pdf_mid - np.log((num_classes - 1) / 2))))
+    def loss(self, logit_probs, log_scales, means, actions, num_classes=256, mask=None):
+        log_probs = self.log_probs_fn(log_scales, means, actions, num_classes, self.log_scale_min)
         log_probs = log_probs + F.log_softmax(logit_probs, dim=-1)
-        loss = -torch.sum(log_sum_exp(log_probs), dim=-1).mean()
-        return loss
+        nll = -torch.sum(torch.logsumexp(log_probs, dim=-1), dim=-1) #B, S
+        if mask is None:
+            return nll.mean()
+        return (nll * mask).sum() / mask.sum() #Padded steps are ignored
     
-    #Sampling from logistic distribution
-    def sample(self, logit_probs, log_scales, means):
+    #Sampling from logistic distribution, inputs (B, S, A, N_DIST) -> actions (B, S, A)
+    #n_samples: K samples per state in one call -> (K, B, S, A)
+    #deterministic: mean of the mixture instead of a sample
+    def sample(self, logit_probs, log_scales, means, n_samples=None, deterministic=False):
+        if deterministic:
+            actions = (F.softmax(logit_probs, dim=-1) * means).sum(dim=-1)
+            return actions.clamp(-0.999, 0.999)
+        if n_samples is not None:
+            logit_probs, log_scales, means = [x.expand(n_samples, *x.shape) \
+                                              for x in (logit_probs, log_scales, means)]
+
         #Selecting Logistic distribution (Gumbel Sample)
         r1, r2 = 1e-5, 1.-1e-5
-        temp = (r1 - r2) * torch.rand(means.shape).cuda() + r2
+        temp = (r1 - r2) * torch.rand(means.shape, device=means.device) + r2
         temp = logit_probs - torch.log(-torch.log(temp)) 
-        argmax = torch.argmax(temp, -1) 
-        dist = one_hot_embedding(argmax, self.n_dist)
+        argmax = torch.argmax(temp, -1, keepdim=True) 
 
         #Select scales and means
-        log_scales = (dist * log_scales).sum(dim=-1)
-        means = (dist * means).sum(dim=-1)
+        log_scales = torch.gather(log_scales, -1, argmax).squeeze(-1)
+        means = torch.gather(means, -1, argmax).squeeze(-1)
 
         #Inversion sampling for logistic mixture sampling
         scales = torch.exp(log_scales) #Make positive
-        u = (r1 - r2) * torch.rand(means.shape).cuda() + r2
+        u = (r1 - r2) * torch.rand(means.shape, device=means.device) + r2
         actions = means + scales * (torch.log(u) - torch.log(1. - u))
 
         #Clipping actions within range
         actions = actions.clamp(-0.999, 0.999)
         return actions
 
-    def forward(self, x):
+    def forward(self, x, lengths=None):
+        x, _ = rnn_forward(self.rnn, x, lengths)
+        return self.mixture_params(x)
+
+    #Streaming decoding for closed loop control, x = (batch, 1, features)
+    #the rnn hidden state is returned to be passed back in the next env step
+    def forward_step(self, x, hidden=None):
+        x, hidden = self.rnn(x, hidden)
+        return self.mixture_params(x), hidden
+
+    def mixture_params(self, x):
         batch_size, seq_len = x.shape[0], x.shape[1]
-        x, _ = self.rnn(x)
         probs = self.prob_fc(x)
         means = self.mean_fc(x)
         log_scales = self.log_scale_fc(x)
@@ -13,6 +13,18 @@ import torch.nn.functional as F
 from torch.nn.parameter import Parameter
 import numpy as np
 import copy
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+
+#Runs a batch_first rnn, with lengths the padded steps after each sequence are skipped
+#and their outputs are zero
+def rnn_forward(rnn, x, lengths=None):
+    if lengths is None:
+        return rnn(x)
+    seq_len = x.shape[1]
+    x = pack_padded_sequence(x, lengths.cpu(), batch_first=True, enforce_sorted=False)
+    x, hn = rnn(x)
+    x, _ = pad_packed_sequence(x, batch_first=True, total_length=seq_len)
+    return x, hn
 
 class VisionNetwork(nn.Module):
     # reference: https://arxiv.org/pdf/2005.07648.pdf
@@ -63,8 +75,9 @@ class SpatialSoftmax(nn.Module):
                 x_map[i, j] = (i - num_rows / 2.0) / num_rows
                 y_map[i, j] = (j - num_cols / 2.0) / num_cols
 
-        self.x_map = torch.from_numpy(np.array(x_map.reshape((-1)), np.float32)).cuda() # W*H
-        self.y_map = torch.from_numpy(np.array(x_map.reshape((-1)), np.float32)).cuda() # W*H
+        # Buffers follow the module in .to(device), not persistent to keep the checkpoint keys
+        self.register_buffer('x_map', torch.from_numpy(np.array(x_map.reshape((-1)), np.float32)), persistent=False) # W*H
+        self.register_buffer('y_map', torch.from_numpy(np.array(x_map.reshape((-1)), np.float32)), persistent=False) # W*H
 
     def forward(self, x):
         x = x.view(x.shape[0], x.shape[1], x.shape[2]*x.shape[3]) # batch, C, W*H
@@ -88,9 +101,12 @@ class PlanRecognitionNetwork(nn.Module):
         self.mean_fc = nn.Linear(in_features=4096, out_features=constants.PLAN_FEATURES) # shape: [N, seq_len, 4096]
         self.variance_fc = nn.Linear(in_features=4096, out_features=constants.PLAN_FEATURES) # shape: [N, seq_len, 4096]
 
-    def forward(self, x):
-        x, hn = self.rnn_model(x)
-        x = x[:, -1] # we just need only last unit output
+    def forward(self, x, lengths=None):
+        x, hn = rnn_forward(self.rnn_model, x, lengths)
+        if lengths is None:
+            x = x[:, -1] # we just need only last unit output
+        else:
+            x = x[torch.arange(x.shape[0], device=x.device), lengths.to(x.device) - 1] # last real frame
         mean = self.mean_fc(x)
         variance = F.softplus(self.variance_fc(x))
         return mean, variance # shape: [N, 256]
@@ -121,7 +137,7 @@ class PlanProposalNetwork(nn.Module):
         return mean, variance # shape: [N, 256]
 
 class LogisticPolicyNetwork(nn.Module):
-    def __init__(self, n_mix=constants.N_LOGITS):
+    def __init__(self, n_mix=constants.N_MIXTURES):
         super(LogisticPolicyNetwork, self).__init__()
         self.in_features = (constants.VISUAL_FEATURES + constants.N_DOF_ROBOT) + constants.VISUAL_FEATURES + constants.PLAN_FEATURES
 
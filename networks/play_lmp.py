@@ -9,25 +9,56 @@ import torch.optim as optim
 import torch.distributions as D
 from torch.distributions.normal import Normal
 import utils.plot as plot
+import utils.constants as constants
+
+class RolloutState():
+    """ State of a rollout for PlayLMP.rollout_step, one per rollout (batch of envs) """
+    def __init__(self, goal_encoding, new_plan_frec=1, stateful=True):
+        self.goal_encoding = goal_encoding #(batch, 64) from PlayLMP.encode_goal
+        self.new_plan_frec = new_plan_frec #sample a new plan every new_plan_frec steps
+        self.stateful = stateful #carry the decoder hidden state between steps, as in training windows
+        self.plan = None
+        self.hidden = None
+        self.steps = 0
+
+    def set_goal(self, goal_encoding):
+        #The current plan was proposed for the previous goal
+        self.goal_encoding = goal_encoding
+        self.plan = None
+        self.hidden = None
 
 class PlayLMP():
-    def __init__(self, lr=2e-4, beta=0.01, num_mixtures=5, use_logistics=False):
+    #use_amp: autocast the networks to amp_dtype ("float16" or "bfloat16"), losses stay in fp32
+    #device: where the networks run, by default cuda if it is available
+    def __init__(self, lr=2e-4, beta=0.01, num_mixtures=5, use_logistics=False, \
+                 use_amp=constants.USE_AMP, amp_dtype=constants.AMP_DTYPE, device=None):
         super(PlayLMP, self).__init__()
-        self.plan_proposal = PlanProposalNetwork().cuda()
-        self.plan_recognition = PlanRecognitionNetwork().cuda()
-        self.vision = VisionNetwork().cuda()
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = torch.device(device)
+        self.plan_proposal = PlanProposalNetwork().to(self.device)
+        self.plan_recognition = PlanRecognitionNetwork().to(self.device)
+        self.vision = VisionNetwork().to(self.device)
         self.num_mixtures = num_mixtures
         self.use_logistics = use_logistics
         if use_logistics:
-            self.action_decoder = LogisticPolicyNetwork(num_mixtures).cuda()
+            self.action_decoder = LogisticPolicyNetwork(num_mixtures).to(self.device)
         else:
-            self.action_decoder = ActionDecoderNetwork(num_mixtures).cuda()
+            self.action_decoder = ActionDecoderNetwork(num_mixtures).to(self.device)
 
         params = list(self.plan_proposal.parameters()) + list(self.plan_recognition.parameters()) \
                  + list(self.action_decoder.parameters()) + list(self.vision.parameters())
         self.optimizer = optim.Adam(params, lr=lr)
         self.beta = beta
 
+        # ------------ Mixed precision ------------ #
+        self.use_amp = use_amp
+        self.amp_dtype = getattr(torch, amp_dtype) if isinstance(amp_dtype, str) else amp_dtype
+        self.device_type = self.device.type
+        #Gradient scaling is only needed for float16, bfloat16 has the fp32 exponent range
+        self.scaler = torch.amp.GradScaler(self.device_type, \
+                            enabled=use_amp and self.amp_dtype == torch.float16)
+
     def train_mode(self):
         self.vision.train()
         self.plan_proposal.train()
@@ -40,25 +71,46 @@ class PlayLMP():
         self.plan_recognition.eval()
         self.action_decoder.eval()
 
+    def autocast(self):
+        return torch.autocast(self.device_type, dtype=self.amp_dtype, enabled=self.use_amp)
+
     def to_tensor(self, array):
-        return torch.tensor(array, dtype=torch.float, device="cuda")
+        return torch.as_tensor(array, dtype=torch.float, device=self.device)
 
-    def get_pp_plan(self, obs, imgs):
+    #Images are kept as uint8 until they reach the device, 4x less host memory and copy
+    def to_image_tensor(self, imgs):
+        if not torch.is_tensor(imgs):
+            imgs = torch.from_numpy(np.ascontiguousarray(imgs))
+        return imgs.to(self.device, non_blocking=True).float()
+
+    #Vision encoding of goal images to be reused while the goal does not change
+    #goal_imgs = (batch_size, 3, 300, 300) -> (batch_size, 64)
+    def encode_goal(self, goal_imgs):
+        self.eval_mode()
+        with torch.no_grad(), self.autocast():
+            goal_imgs = self.to_image_tensor(goal_imgs)
+            goal_encoding = self.vision(goal_imgs).float()
+        return goal_encoding
+
+    def get_pp_plan(self, obs, imgs, goal_encoding=None):
         #obs = (batch_size, 9)
         #imgs = (batch_size, 2, 3, 300, 300)
+        #or with goal_encoding (batch_size, 64) from encode_goal, only the current image
+        #imgs = (batch_size, 1, 3, 300, 300)
         self.eval_mode()
-        with torch.no_grad():
+        with torch.no_grad(), self.autocast():
             b, s, c, h, w = imgs.shape
-            imgs = self.to_tensor(imgs).reshape(-1, c, h, w)
+            imgs = self.to_image_tensor(imgs).reshape(-1, c, h, w)
             # ------------ Vision Network ------------ #
             encoded_imgs = self.vision(imgs)
             encoded_imgs = encoded_imgs.reshape(b, s, -1)
+            goal = encoded_imgs[:,-1] if goal_encoding is None else goal_encoding
 
             # ------------Plan Proposal------------ #
             obs = self.to_tensor(obs)
-            pp_input = torch.cat([encoded_imgs[:, 0], obs, encoded_imgs[:,-1]], dim=-1)
+            pp_input = torch.cat([encoded_imgs[:, 0], obs, goal], dim=-1)
             mu_p, sigma_p = self.plan_proposal(pp_input)#(batch, 256) each
-            pp_dist = Normal(mu_p, sigma_p)
+            pp_dist = Normal(mu_p.float(), sigma_p.float())
             sampled_plan = pp_dist.sample()
         return sampled_plan
 
@@ -67,9 +119,9 @@ class PlayLMP():
         #obs = (batch_size, seq_len, 9)
         #imgs = (batch_size, seq_len , 3, 300, 300)
         self.eval_mode()
-        with torch.no_grad():
+        with torch.no_grad(), self.autocast():
             b, s, c, h, w = imgs.shape
-            imgs = self.to_tensor(imgs).reshape(-1, c, h, w)
+            imgs = self.to_image_tensor(imgs).reshape(-1, c, h, w)
             # ------------ Vision Network ------------ #
             encoded_imgs = self.vision(imgs)
             encoded_imgs = encoded_imgs.reshape(b, s, -1)
@@ -79,61 +131,84 @@ class PlayLMP():
             obs = self.to_tensor(obs)
             pr_input = torch.cat([encoded_imgs, obs], dim=-1)
             mu_p, sigma_p = self.plan_recognition(pr_input)#(batch, 256) each
-            pr_dist = Normal(mu_p, sigma_p)
+            pr_dist = Normal(mu_p.float(), sigma_p.float())
             sampled_plan = pr_dist.sample()
         return sampled_plan
 
     #Forward + loss + backward
-    def step(self, obs, imgs, acts):
+    #lengths: optional number of real frames of every window when the batch is padded
+    #after the window (PaddedRelayKitchen), padded frames are skipped by every network
+    def step(self, obs, imgs, acts, lengths=None):
         self.train_mode()
         b, s, c, h, w = imgs.shape
-        imgs = self.to_tensor(imgs).reshape(-1, c, h, w) #(batch_size * sequence_length, 3, 300, 300)
-
-        # ------------ Vision Network ------------ #
-        encoded_imgs = self.vision(imgs) #(batch*seq_len, 64)
-        encoded_imgs = encoded_imgs.reshape(b, s, -1) #(batch, seq, 64)
-
-        # ------------Plan Proposal------------ #
-        #plan proposal input = cat(visuo_proprio, goals) = (batch, 137)
-        obs = self.to_tensor(obs)
-        pp_input = torch.cat([encoded_imgs[:, 0], obs[:,0], encoded_imgs[:,-1]], dim=-1)
-        mu_p, sigma_p = self.plan_proposal(pp_input)#(batch, 256) each
-        pp_dist = Normal(mu_p, sigma_p)
-
-        # ------------Plan Recognition------------ #
-        #plan proposal input = visuo_proprio =  (batch_size, sequence_length, 73)
-        pr_input = torch.cat([encoded_imgs, obs], dim=-1)
-        mu_r, sigma_r = self.plan_recognition(pr_input)#(batch, 256) each
-        pr_dist = Normal(mu_r, sigma_r)
-
-        # ------------ Policy network ------------ #
-        sampled_plan = pr_dist.rsample() #sample from recognition net
-        #action_input = torch.cat([pp_input, sampled_plan], dim=-1).unsqueeze(1)
-        goal_plan = torch.cat([encoded_imgs[:,-1], sampled_plan], dim=-1) #b, 64 + 256
-        goal_plan = goal_plan.unsqueeze(1).expand(-1, s, -1) #b, s, 64 + 256
-        action_input = torch.cat([pr_input, goal_plan], dim=-1) #b, s, 64 + 9 + 64 + 256 (visuo-propio + goal + plan)
+        mask = None
+        if lengths is not None:
+            lengths = torch.as_tensor(lengths, dtype=torch.long).cpu()
+            mask = torch.arange(s).unsqueeze(0) < lengths.unsqueeze(1) #(batch, seq)
+            imgs = torch.as_tensor(imgs).reshape(-1, c, h, w)
+            imgs = imgs[mask.reshape(-1).to(imgs.device)] #(real frames, 3, 300, 300)
+        imgs = self.to_image_tensor(imgs).reshape(-1, c, h, w) #(batch_size * sequence_length, 3, 300, 300)
+
+        with self.autocast():
+            # ------------ Vision Network ------------ #
+            encoded_imgs = self.vision(imgs) #(batch*seq_len, 64)
+            if mask is not None:
+                mask = mask.to(encoded_imgs.device)
+                padded_imgs = encoded_imgs.new_zeros(b * s, encoded_imgs.shape[-1])
+                padded_imgs[mask.reshape(-1)] = encoded_imgs
+                encoded_imgs = padded_imgs
+            encoded_imgs = encoded_imgs.reshape(b, s, -1) #(batch, seq, 64)
+            if lengths is None:
+                goal_imgs = encoded_imgs[:, -1]
+            else:
+                goal_imgs = encoded_imgs[torch.arange(b), lengths.to(encoded_imgs.device) - 1] #last real frame
+
+            # ------------Plan Proposal------------ #
+            #plan proposal input = cat(visuo_proprio, goals) = (batch, 137)
+            obs = self.to_tensor(obs)
+            pp_input = torch.cat([encoded_imgs[:, 0], obs[:,0], goal_imgs], dim=-1)
+            mu_p, sigma_p = self.plan_proposal(pp_input)#(batch, 256) each
+            pp_dist = Normal(mu_p.float(), sigma_p.float())
+
+            # ------------Plan Recognition------------ #
+            #plan proposal input = visuo_proprio =  (batch_size, sequence_length, 73)
+            pr_input = torch.cat([encoded_imgs, obs], dim=-1)
+            mu_r, sigma_r = self.plan_recognition(pr_input, lengths)#(batch, 256) each
+            pr_dist = Normal(mu_r.float(), sigma_r.float())
+
+            # ------------ Policy network ------------ #
+            sampled_plan = pr_dist.rsample() #sample from recognition net
+            #action_input = torch.cat([pp_input, sampled_plan], dim=-1).unsqueeze(1)
+            goal_plan = torch.cat([goal_imgs, sampled_plan], dim=-1) #b, 64 + 256
+            goal_plan = goal_plan.unsqueeze(1).expand(-1, s, -1) #b, s, 64 + 256
+            action_input = torch.cat([pr_input, goal_plan], dim=-1) #b, s, 64 + 9 + 64 + 256 (visuo-propio + goal + plan)
         
-        pi, sigma, mu = self.action_decoder(action_input)
+            pi, sigma, mu = self.action_decoder(action_input, lengths)
         acts = self.to_tensor(acts) # B, S, 9
 
         # ------------ Loss ------------ #
+        #Mixture likelihood and KL divergence are always computed in fp32
+        pi, sigma, mu = pi.float(), sigma.float(), mu.float()
         kl_loss = D.kl_divergence(pr_dist, pp_dist).mean()
-        mix_loss = self.action_decoder.loss(pi, sigma, mu, acts)
-        total_loss = 1/s * mix_loss + self.beta * kl_loss 
+        mix_loss = self.action_decoder.loss(pi, sigma, mu, acts, mask=mask)
+        #Scaled by the real window length, padded batches weigh the same as unpadded ones
+        window_size = s if lengths is None else lengths.float().mean().item()
+        total_loss = 1/window_size * mix_loss + self.beta * kl_loss 
 
         # ------------ Backward pass ------------ #
         self.optimizer.zero_grad()
-        total_loss.backward()
-        self.optimizer.step()
+        self.scaler.scale(total_loss).backward()
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
 
         return total_loss, mix_loss, kl_loss
 
     #Evaluation in test set, no grad, no labels
     def predict(self, obs, imgs):
         self.eval_mode()
-        with torch.no_grad():
+        with torch.no_grad(), self.autocast():
             b, s, c, h, w = imgs.shape
-            imgs = self.to_tensor(imgs).reshape(-1, c, h, w)
+            imgs = self.to_image_tensor(imgs).reshape(-1, c, h, w)
             # ------------ Vision Network ------------ #
             encoded_imgs = self.vision(imgs)
             encoded_imgs = encoded_imgs.reshape(b, s, -1)
@@ -142,12 +217,12 @@ class PlayLMP():
             obs = self.to_tensor(obs)
             pp_input = torch.cat([encoded_imgs[:, 0], obs, encoded_imgs[:,-1]], dim=-1)
             mu_p, sigma_p = self.plan_proposal(pp_input)#(batch, 256) each
-            pp_dist = Normal(mu_p, sigma_p)
+            pp_dist = Normal(mu_p.float(), sigma_p.float())
 
             # ------------ Policy network ------------ #
             sampled_plan = pp_dist.sample() #sample from proposal net
             action_input = torch.cat([pp_input, sampled_plan], dim=-1).unsqueeze(1)
-            pi, sigma, mu = self.action_decoder(action_input)
+            pi, sigma, mu = [x.float() for x in self.action_decoder(action_input)]
             action = self.action_decoder.sample(pi, sigma, mu)
 
         return action
@@ -156,9 +231,9 @@ class PlayLMP():
     #inputs: numpy arrays (Batch, seq_len, dim)
     def predict_eval(self, obs, imgs, act):
         self.eval_mode()
-        with torch.no_grad():
+        with torch.no_grad(), self.autocast():
             b, s, c, h, w = imgs.shape
-            imgs = self.to_tensor(imgs).reshape(-1, c, h, w)
+            imgs = self.to_image_tensor(imgs).reshape(-1, c, h, w)
             # ------------ Vision Network ------------ #
             encoded_imgs = self.vision(imgs)
             encoded_imgs = encoded_imgs.reshape(b, s, -1)
@@ -167,12 +242,12 @@ class PlayLMP():
             obs = self.to_tensor(obs)
             pp_input = torch.cat([encoded_imgs[:, 0], obs, encoded_imgs[:,-1]], dim=-1)
             mu_p, sigma_p = self.plan_proposal(pp_input)#(batch, 256) each
-            pp_dist = Normal(mu_p, sigma_p)
+            pp_dist = Normal(mu_p.float(), sigma_p.float())
 
             # ------------ Policy network ------------ #
             sampled_plan = pp_dist.sample() #sample from proposal net
             action_input = torch.cat([pp_input, sampled_plan], dim=-1).unsqueeze(1)
-            pi, sigma, mu= self.action_decoder(action_input)
+            pi, sigma, mu = [x.float() for x in self.action_decoder(action_input)]
             action = self.action_decoder.sample(pi, sigma, mu)
 
 
@@ -187,37 +262,74 @@ class PlayLMP():
             accuracy = np.mean(np.all(accuracy, axis=-1))
         return accuracy, mix_loss
 
-    def predict_with_plan(self, obs, imgs, plan):
-        with torch.no_grad():
+    #Same inputs as get_pp_plan
+    def predict_with_plan(self, obs, imgs, plan, goal_encoding=None):
+        with torch.no_grad(), self.autocast():
             b, s, c, h, w = imgs.shape
-            imgs = self.to_tensor(imgs).reshape(-1, c, h, w)
+            imgs = self.to_image_tensor(imgs).reshape(-1, c, h, w)
             # ------------ Vision Network ------------ #
             encoded_imgs = self.vision(imgs)
             encoded_imgs = encoded_imgs.reshape(b, s, -1)
+            goal = encoded_imgs[:,-1] if goal_encoding is None else goal_encoding
 
             # ------------Plan Proposal------------ #
             obs = self.to_tensor(obs)
-            pp_input = torch.cat([encoded_imgs[:, 0], obs, encoded_imgs[:,-1]], dim=-1)
+            pp_input = torch.cat([encoded_imgs[:, 0], obs, goal], dim=-1)
             action_input = torch.cat([pp_input, plan], dim=-1).unsqueeze(1)
-            pi, sigma, mu = self.action_decoder(action_input)
+            pi, sigma, mu = [x.float() for x in self.action_decoder(action_input)]
             action = self.action_decoder.sample(pi, sigma, mu)
         return action
 
+    #Fused rollout step, the current image is encoded once and used to plan and to act
+    #obs = (batch_size, 9), imgs = (batch_size, 3, 300, 300)
+    #returns action = (batch_size, 1, 9) and the plan used = (batch_size, 256)
+    def rollout_step(self, obs, imgs, state):
+        self.eval_mode()
+        with torch.no_grad(), self.autocast():
+            # ------------ Vision Network ------------ #
+            encoded_imgs = self.vision(self.to_image_tensor(imgs))
+
+            # ------------Plan Proposal------------ #
+            obs = self.to_tensor(obs)
+            pp_input = torch.cat([encoded_imgs, obs, state.goal_encoding], dim=-1)
+            if state.plan is None or state.steps % state.new_plan_frec == 0:
+                mu_p, sigma_p = self.plan_proposal(pp_input)#(batch, 256) each
+                state.plan = Normal(mu_p.float(), sigma_p.float()).sample()
+                state.hidden = None #a new plan starts a new decoding window
+
+            # ------------ Policy network ------------ #
+            action_input = torch.cat([pp_input, state.plan], dim=-1).unsqueeze(1)
+            if state.stateful:
+                outputs, state.hidden = self.action_decoder.forward_step(action_input, state.hidden)
+            else:
+                outputs = self.action_decoder(action_input)
+            pi, sigma, mu = [x.float() for x in outputs]
+            action = self.action_decoder.sample(pi, sigma, mu)
+        state.steps += 1
+        return action, state.plan
+
+    def state_dict(self):
+        return {'plan_proposal': self.plan_proposal.state_dict(),
+                'plan_recognition' : self.plan_recognition.state_dict(),
+                'action_decoder' : self.action_decoder.state_dict(),
+                'vision' : self.vision.state_dict(),
+                }
+
+    #Weights are copied into the existing parameters, e.g. a snapshot of another PlayLMP
+    def load_state_dict(self, state_dict):
+        self.plan_proposal.load_state_dict(state_dict['plan_proposal'])
+        self.plan_recognition.load_state_dict(state_dict['plan_recognition'])
+        self.action_decoder.load_state_dict(state_dict['action_decoder'])
+        self.vision.load_state_dict(state_dict['vision'])
+
     def save(self, file_name):
-        torch.save({'plan_proposal': self.plan_proposal.state_dict(),
-                    'plan_recognition' : self.plan_recognition.state_dict(),
-                    'action_decoder' : self.action_decoder.state_dict(),
-                    'vision' : self.vision.state_dict(),
-                }, file_name)
+        torch.save(self.state_dict(), file_name)
 
     def load(self, file_name):
         if os.path.isfile(file_name):
             print("=> loading checkpoint... ")
-            checkpoint = torch.load(file_name)
-            self.plan_proposal.load_state_dict(checkpoint['plan_proposal'])
-            self.plan_recognition.load_state_dict(checkpoint['plan_recognition'])
-            self.action_decoder.load_state_dict(checkpoint['action_decoder'])
-            self.vision.load_state_dict(checkpoint['vision'])
+            checkpoint = torch.load(file_name, map_location=self.device)
+            self.load_state_dict(checkpoint)
             print("done !")
         else:
             print("no checkpoint found...")
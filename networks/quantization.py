@@ -0,0 +1,138 @@
+import argparse
+import copy
+import io
+import os
+import sys
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.nn.utils.rnn import PackedSequence
+from networks.play_lmp import PlayLMP
+from preprocessing import read_data, window_batches, unzip_batches
+from utils.benchmark import time_fn
+import utils.constants as constants
+
+class RNNCellStack(nn.Module):
+    """ Same outputs as a batch_first, unidirectional nn.RNN built from one nn.RNNCell per layer
+        with the weights of rnn. Dynamic quantization supports RNNCell but not the relu nn.RNN.
+        Padded sequences are not supported, inference only """
+    def __init__(self, rnn):
+        super(RNNCellStack, self).__init__()
+        assert rnn.batch_first and not rnn.bidirectional
+        self.hidden_size = rnn.hidden_size
+        self.cells = nn.ModuleList()
+        for layer in range(rnn.num_layers):
+            input_size = rnn.input_size if layer == 0 else rnn.hidden_size
+            cell = nn.RNNCell(input_size, rnn.hidden_size, bias=rnn.bias, nonlinearity=rnn.nonlinearity)
+            with torch.no_grad():
+                cell.weight_ih.copy_(getattr(rnn, 'weight_ih_l%d' % layer))
+                cell.weight_hh.copy_(getattr(rnn, 'weight_hh_l%d' % layer))
+                if rnn.bias:
+                    cell.bias_ih.copy_(getattr(rnn, 'bias_ih_l%d' % layer))
+                    cell.bias_hh.copy_(getattr(rnn, 'bias_hh_l%d' % layer))
+            self.cells.append(cell.to(rnn.weight_ih_l0.device))
+
+    #x = (batch, seq_len, features), hidden = (num_layers, batch, hidden_size)
+    def forward(self, x, hidden=None):
+        if isinstance(x, PackedSequence):
+            raise ValueError("RNNCellStack does not support padded windows (lengths)")
+        if hidden is None:
+            hidden = x.new_zeros(len(self.cells), x.shape[0], self.hidden_size)
+        hidden = list(hidden.unbind(0))
+        outputs = []
+        for t in range(x.shape[1]):
+            h = x[:, t]
+            for layer, cell in enumerate(self.cells):
+                h = hidden[layer] = cell(h, hidden[layer])
+            outputs.append(h)
+        return torch.stack(outputs, dim=1), torch.stack(hidden, dim=0)
+
+#Post-training dynamic int8 quantization of a PlayLMP for cpu inference (get_pp_plan, predict_with_plan,
+#predict_eval, rollout_step). Weights are int8, activations are quantized on the fly every call.
+#The vision convs stay in float32. The quantized model cannot be trained or saved as a float checkpoint
+def quantize_dynamic(model, inplace=False):
+    assert model.device.type == 'cpu', "quantized kernels only run on cpu"
+    if not inplace:
+        model = copy.deepcopy(model)
+    model.eval_mode()
+    model.use_amp = False #int8 kernels take float32 inputs
+    model.action_decoder.rnn = RNNCellStack(model.action_decoder.rnn)
+    for name in ['vision', 'plan_proposal', 'plan_recognition', 'action_decoder']:
+        module = torch.ao.quantization.quantize_dynamic(getattr(model, name), {nn.Linear, nn.LSTM, nn.RNNCell}, \
+                                                        dtype=torch.qint8)
+        setattr(model, name, module)
+    return model
+
+#Serialized size of the weights, the packed int8 weights are not regular parameters
+def model_bytes(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+#Accuracy regression check: predict_eval of the float and the quantized model on the same batches,
+#with the same seed per batch so both sample the same noise. Returns True if the accuracy drops
+#less than max_accuracy_drop
+def check_accuracy(model, qmodel, val_batches, max_accuracy_drop=0.02, seed=0):
+    results = {}
+    for name, m in [('float32', model), ('int8', qmodel)]:
+        accuracy, mix_loss = 0, 0
+        for i, (val_obs, val_imgs, val_acts) in enumerate(val_batches):
+            torch.manual_seed(seed + i)
+            batch_accuracy, batch_mix_loss = m.predict_eval(val_obs, val_imgs, val_acts)
+            accuracy += batch_accuracy
+            mix_loss += batch_mix_loss.item()
+        results[name] = (accuracy / len(val_batches), mix_loss / len(val_batches))
+        print("%s: validation accuracy %.4f, mixture loss %.4f" % (name, *results[name]))
+    accuracy_drop = results['float32'][0] - results['int8'][0]
+    passed = accuracy_drop < max_accuracy_drop
+    print("accuracy drop %.4f (max %.4f): %s" % (accuracy_drop, max_accuracy_drop, "ok" if passed else "FAILED"))
+    return passed
+
+#Latency of a rollout step (get_pp_plan + predict_with_plan) with the goal encoded once
+def rollout_latency(model, obs, imgs, n_iters=20):
+    goal_encoding = model.encode_goal(imgs[:, -1])
+    def step():
+        plan = model.get_pp_plan(obs, imgs[:, :1], goal_encoding)
+        return model.predict_with_plan(obs, imgs[:, :1], plan, goal_encoding)
+    return time_fn(step, n_iters)
+
+#Random validation batches with the shapes of window_batches(..., validation=True)
+def random_val_batches(n_batches, batch_size):
+    rng = np.random.RandomState(0)
+    return [(rng.randn(batch_size, constants.N_DOF_ROBOT).astype(np.float32),
+             rng.randint(0, 256, (batch_size, 2, 3, 300, 300), dtype=np.uint8),
+             rng.uniform(-1, 1, (batch_size, constants.N_DOF_ROBOT)).astype(np.float32)) for _ in range(n_batches)]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Dynamic int8 quantization of PlayLMP, accuracy and cpu latency')
+    parser.add_argument('--model_name', type=str, default="10_logistic_multitask_bestacc_new")
+    parser.add_argument('--n_mixtures', type=int, default=constants.N_MIXTURES)
+    parser.add_argument('--use_logistics', type=int, default=int(constants.USE_LOGISTICS))
+    parser.add_argument('--data_dir', type=str, default="./data/validation")
+    parser.add_argument('--n_batches', type=int, default=5)
+    parser.add_argument('--batch_size', type=int, default=constants.VAL_BATCH_SIZE)
+    parser.add_argument('--random_data', action='store_true', help='random batches instead of data_dir')
+    parser.add_argument('--max_accuracy_drop', type=float, default=0.02)
+    parser.add_argument('--threads', type=int, default=1, help='cpu threads, one per rollout worker')
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+
+    #model needs to be placed on "./models/"
+    model = PlayLMP(num_mixtures=args.n_mixtures, use_logistics=bool(args.use_logistics), device="cpu")
+    model.load('./models/%s.pth' % args.model_name)
+    qmodel = quantize_dynamic(model)
+    print("Model size: float32 %.1f MB, int8 %.1f MB" % (model_bytes(model) / 2**20, model_bytes(qmodel) / 2**20))
+
+    if args.random_data or not os.path.isdir(args.data_dir):
+        val_batches = random_val_batches(args.n_batches, args.batch_size)
+    else:
+        #Same validation batches as training.py, [current_img, goal_img], current_obs, current_action
+        validation_paths = read_data(args.data_dir)
+        val_batches = window_batches(validation_paths, constants.WINDOW_SIZE, args.batch_size, True)
+        val_batches = list(zip(*unzip_batches(val_batches[i] for i in range(min(args.n_batches, len(val_batches))))))
+    passed = check_accuracy(model, qmodel, val_batches, args.max_accuracy_drop)
+
+    val_obs, val_imgs, _ = val_batches[0]
+    for name, m in [('float32', model), ('int8', qmodel)]:
+        print("%s: rollout step %.2f ms" % (name, rollout_latency(m, val_obs[:1], val_imgs[:1]) * 1000))
+    sys.exit(0 if passed else 1)
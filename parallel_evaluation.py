@@ -0,0 +1,229 @@
+import argparse
+import multiprocessing as mp
+import os
+import sys
+import time
+import numpy as np
+import matplotlib.pyplot as plt
+import torch
+from networks.play_lmp import PlayLMP, RolloutState
+from utils.rendering import FrameRenderer, VideoRecorder
+
+#Kitchen env as used in test_single_goal.py, only imported inside the worker processes
+def make_kitchen_env():
+    import gym
+    sys.path.append("./relay-policy-learning/adept_envs/")
+    import adept_envs
+    return gym.make('kitchen_relax-v1').env
+
+class FakeKitchenEnv():
+    """ Lightweight env with the reset/step/render interface of kitchen_relax-v1,
+        to test the evaluator without MuJoCo """
+    def __init__(self, obs_size=60, img_size=(480, 640), seed=None):
+        self.obs_size = obs_size
+        self.img_size = img_size
+        self.random_state = np.random.RandomState(seed)
+
+    def reset(self):
+        return self.random_state.randn(self.obs_size)
+
+    def step(self, action):
+        return self.random_state.randn(self.obs_size), 0., False, {}
+
+    def render(self, mode='rgb_array'):
+        return self.random_state.randint(0, 256, self.img_size + (3,), dtype=np.uint8)
+
+    def close(self):
+        pass
+
+#Video of an episode at 10 fps, same size and frame skip as the test_single_goal.py videos
+class EpisodeVideo():
+    def __init__(self, env, filename, fps=10, frame_size=(640, 852)):
+        self.renderer = FrameRenderer(env, frame_size, aspect=frame_size[1]/frame_size[0])
+        self.recorder = VideoRecorder(filename)
+        self.render_skip = 1
+        if hasattr(env, 'sim'):
+            self.render_skip = max(1, round(1. / (fps * env.sim.model.opt.timestep * env.frame_skip)))
+        self.step = 0
+
+    def add_frame(self):
+        if self.step % self.render_skip == 0:
+            self.recorder.add_frame(self.renderer.render())
+        self.step += 1
+
+    def close(self):
+        self.recorder.close()
+
+#Runs in its own process, commands: ('reset', video filename or None), ('step', action), ('close', None)
+#A reset closes the video of the previous episode
+def env_worker(remote, env_fn):
+    env = env_fn()
+    renderer = FrameRenderer(env)
+    video = None
+    while True:
+        cmd, data = remote.recv()
+        if cmd == 'reset':
+            if video is not None:
+                video.close()
+            s = env.reset()
+            video = None if data is None else EpisodeVideo(env, data)
+            remote.send((s, renderer.render()))
+        elif cmd == 'step':
+            s, r, done, env_info = env.step(data)
+            if video is not None:
+                video.add_frame()
+            remote.send((s, renderer.render(), r, done, env_info))
+        elif cmd == 'close':
+            if video is not None:
+                video.close()
+            env.close()
+            remote.close()
+            break
+
+class SubprocVecEnv():
+    """ One env per worker process. reset and step work on the first n envs and return the
+        states (n, obs) and frames (n, 300, 300, 3) as batches, step also returns the rewards (n,),
+        dones (n,) and the list of env_info dicts """
+    def __init__(self, env_fns):
+        self.remotes, self.processes = [], []
+        for env_fn in env_fns:
+            remote, worker_remote = mp.Pipe()
+            process = mp.Process(target=env_worker, args=(worker_remote, env_fn), daemon=True)
+            process.start()
+            worker_remote.close()
+            self.remotes.append(remote)
+            self.processes.append(process)
+
+    def __len__(self):
+        return len(self.remotes)
+
+    def gather(self, n):
+        return list(zip(*[remote.recv() for remote in self.remotes[:n]]))
+
+    #video_files: one filename or None per env, the episode is recorded by the worker
+    def reset(self, n=None, video_files=None):
+        n = len(self) if n is None else n
+        video_files = [None] * n if video_files is None else video_files
+        for remote, video_file in zip(self.remotes[:n], video_files):
+            remote.send(('reset', video_file))
+        states, frames = self.gather(n)
+        return np.stack(states), np.stack(frames)
+
+    def step(self, actions):
+        #Scatter one action per env, all envs step in parallel
+        for remote, action in zip(self.remotes, actions):
+            remote.send(('step', action))
+        states, frames, rewards, dones, env_infos = self.gather(len(actions))
+        return np.stack(states), np.stack(frames), np.array(rewards), np.array(dones), list(env_infos)
+
+    def close(self):
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for process in self.processes:
+            process.join()
+
+def load_goal(goal_path):
+    goal = plt.imread(goal_path) #read as RGB, blue shelfs
+    return np.rint(goal*255).astype(np.uint8) #change to model scale
+
+def gpu_utilization():
+    if not torch.cuda.is_available():
+        return None
+    try:
+        return torch.cuda.utilization() #needs pynvml
+    except Exception:
+        return None
+
+#Runs n_runs episodes for every goal, n_envs episodes at a time.
+#Every env step is a single batched PlayLMP.rollout_step for all the envs.
+#goals: dict goal name -> goal image (300, 300, 3) uint8
+#Returns results, stats. results: dict goal name -> list of n_runs episodes, every episode is a dict
+#with the 'return', 'done' (if the env returned done in any step), 'done_step' (first one, or None)
+#and the 'env_info' of the last step. The envs are not reset on done, as in test_single_goal.py
+#save_folder: one video per episode, save_folder/goal name/<video_prefix>goal name(run).mp4
+def evaluate(model, goals, env_fn=make_kitchen_env, n_envs=4, n_runs=5, env_steps=400, \
+             new_plan_frec=10, stateful_decoding=True, save_folder=None, video_prefix=""):
+    names = list(goals.keys())
+    goal_imgs = np.stack([goals[name] for name in names]).transpose(0,3,1,2)
+    goal_encodings = model.encode_goal(goal_imgs) #every goal is encoded once
+    episodes = [(i, run) for i in range(len(names)) for run in range(n_runs)]
+    results = {name: [] for name in names}
+    if save_folder is not None:
+        for name in names:
+            if not os.path.exists(os.path.join(save_folder, name)):
+                os.makedirs(os.path.join(save_folder, name))
+
+    start_time, start_cpu = time.perf_counter(), os.times()
+    vec_env = SubprocVecEnv([env_fn] * n_envs)
+    gpu_samples = []
+    for i in range(0, len(episodes), n_envs):
+        group = episodes[i:i + n_envs]
+        goal_ids = [goal_id for goal_id, _ in group]
+        n = len(group) #the last group can have less than n_envs episodes
+        print("Episodes %d-%d of %d" % (i + 1, i + n, len(episodes)))
+        video_files = None
+        if save_folder is not None:
+            video_files = [os.path.join(save_folder, names[goal_id], "%s%s(%d).mp4" % \
+                                        (video_prefix, names[goal_id], run)) for goal_id, run in group]
+        rollout = RolloutState(goal_encodings[goal_ids], new_plan_frec, stateful_decoding)
+        s, frames = vec_env.reset(n, video_files)
+        returns, done_steps, env_infos = np.zeros(n), [None] * n, [None] * n
+        for step in range(env_steps):
+            current_imgs = frames.transpose(0,3,1,2) #(n, 3, 300, 300)
+            actions, _ = model.rollout_step(s[:, :9], current_imgs, rollout)
+            s, frames, rewards, dones, env_infos = vec_env.step(actions[:, 0].cpu().numpy())
+            returns += rewards
+            for j in np.flatnonzero(dones):
+                if done_steps[j] is None:
+                    done_steps[j] = step
+            gpu_samples.append(gpu_utilization())
+        for j, goal_id in enumerate(goal_ids):
+            results[names[goal_id]].append({'return': float(returns[j]), 'done': done_steps[j] is not None,
+                                            'done_step': done_steps[j], 'env_info': env_infos[j]})
+    vec_env.close()
+    wall_time = time.perf_counter() - start_time
+    end_cpu = os.times()
+
+    #Workers are joined, so their cpu time is included in the children times
+    main_cpu = (end_cpu.user + end_cpu.system) - (start_cpu.user + start_cpu.system)
+    workers_cpu = (end_cpu.children_user + end_cpu.children_system) - \
+                  (start_cpu.children_user + start_cpu.children_system)
+    stats = {'episodes': len(episodes),
+             'episodes_per_sec': len(episodes) / wall_time,
+             'env_steps_per_sec': len(episodes) * env_steps / wall_time,
+             'main_cpu_utilization': main_cpu / wall_time,
+             'workers_cpu_utilization': workers_cpu / wall_time}
+    gpu_samples = [x for x in gpu_samples if x is not None]
+    if gpu_samples:
+        stats['gpu_utilization'] = np.mean(gpu_samples) / 100
+    for name in names:
+        episode_returns = [episode['return'] for episode in results[name]]
+        done_rate = np.mean([episode['done'] for episode in results[name]])
+        print("%s: return %.2f +- %.2f, done %.2f" % (name, np.mean(episode_returns), np.std(episode_returns), done_rate))
+    for key, value in stats.items():
+        print("%s: %.2f" % (key, value))
+    return results, stats
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Evaluate a model on several envs in parallel')
+    parser.add_argument('--model_name', type=str, default="10_logistic_multitask_bestacc_new")
+    parser.add_argument('--goals', type=str, nargs='+', default=["microwave", "bottomknob"])
+    parser.add_argument('--n_envs', type=int, default=4)
+    parser.add_argument('--n_runs', type=int, default=5)
+    parser.add_argument('--env_steps', type=int, default=400)
+    parser.add_argument('--new_plan_frec', type=int, default=10)
+    parser.add_argument('--fake_env', action='store_true', help='random weights, goals and envs')
+    parser.add_argument('--save_folder', type=str, default=None, help='save a video of every episode')
+    args = parser.parse_args()
+
+    model = PlayLMP(num_mixtures=10, use_logistics=True)
+    if args.fake_env:
+        env_fn = FakeKitchenEnv
+        goals = {name: np.random.randint(0, 256, (300, 300, 3), dtype=np.uint8) for name in args.goals}
+    else:
+        #model needs to be placed on "./models/"
+        model.load('./models/%s.pth' % args.model_name)
+        env_fn = make_kitchen_env
+        goals = {name: load_goal("./data/goals/%s.png" % name) for name in args.goals}
+    evaluate(model, goals, env_fn, args.n_envs, args.n_runs, args.env_steps, args.new_plan_frec, \
+             save_folder=args.save_folder, video_prefix="%s_npf_%d_" % (args.model_name, args.new_plan_frec))
@@ -4,6 +4,7 @@ import os
 import gzip
 import matplotlib.pyplot as plt
 import glob
+from dataset_storage import is_memmap_dir, load_memmap_paths
 
 #Load data from specific packages
 def load_data(file_names):
@@ -25,6 +26,8 @@ def load_data(file_names):
 def read_data(datasets_dir="./data/training"):
     name_str = os.path.basename(os.path.normpath(datasets_dir))
     print("Read %s data ..."%name_str)
+    if is_memmap_dir(datasets_dir):
+        return load_memmap_paths(datasets_dir)
     file_names = get_filenames(datasets_dir)
     return load_data(file_names)
 
@@ -33,116 +36,102 @@ def get_filenames(datasets_dir="./data/training"):
     np.random.shuffle(file_names)
     return file_names
 
-#For validation
-def mult_wind_preprocessing(paths, min_ws, max_ws, batch_size=64):
-    #Complete paths -> List of windows
+#Lazy list of batches of windows, only the raw paths are kept in memory.
+#Every batch is gathered from (path, start, window size) index arrays when accessed.
+class WindowBatches():
+    def __init__(self, paths, path_ids, starts, window_sizes, batch_size=64, validation=False, \
+                 shuffle=True, reset_seed=False):
+        self.paths = paths
+        self.path_ids = np.asarray(path_ids, dtype=np.int64)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.window_sizes = np.asarray(window_sizes, dtype=np.int64)
+        self.validation = validation
+
+        #Shuffle inds
+        inds = np.arange(self.starts.shape[0])
+        if(shuffle):
+            if(reset_seed):
+                np.random.seed(0) #same numbers..
+            np.random.shuffle(inds)
+
+        #Split to batches
+        num_splits = inds.shape[0]//batch_size
+        self.batch_inds = np.array_split(inds, num_splits)
+
+    def __len__(self):
+        return len(self.batch_inds)
+
+    def __getitem__(self, i):
+        seq_obs, seq_imgs, seq_acts = [], [], []
+        for ind in self.batch_inds[i]:
+            path = self.paths[self.path_ids[ind]]
+            t, window_size = self.starts[ind], self.window_sizes[ind]
+            if(self.validation):
+                #For validation data
+                #return: [current_img, goal_img] , current_obs, current_action
+                seq_obs.append(path['observations'][t])
+                seq_imgs.append(np.stack((path['images'][t], path['images'][t+window_size])))
+                seq_acts.append(path['actions'][t])
+            else:
+                seq_obs.append(path['observations'][t: t+window_size])
+                seq_imgs.append(path['images'][t: t+window_size])
+                seq_acts.append(path['actions'][t: t+window_size])
+
+        #List -> numpy array
+        seq_obs = np.stack(seq_obs, axis=0) #Train = B, S, O | Val = B, O
+        seq_imgs = np.stack(seq_imgs, axis=0) #B, S, H, W, C
+        seq_imgs = np.transpose(seq_imgs, (0, 1, 4, 2, 3)) #B, S, C, H, W
+        seq_acts = np.stack(seq_acts, axis=0) #Train = B, S, A | Val = B, A
+        return seq_obs, seq_imgs, seq_acts
+
+#Every window that fits in the paths: t + window_size <= n - 1
+def window_index(paths, window_size=16):
+    path_ids, starts = [], []
+    for i, path in enumerate(paths):
+        n_windows = max(path['observations'].shape[0] - window_size, 0)
+        path_ids.append(np.full(n_windows, i, dtype=np.int64))
+        starts.append(np.arange(n_windows, dtype=np.int64))
+    path_ids, starts = np.concatenate(path_ids), np.concatenate(starts)
+    return path_ids, starts, np.full(starts.shape[0], window_size, dtype=np.int64)
+
+#List of batches -> lists of obs, imgs and acts batches
+def unzip_batches(batches):
     seq_obs, seq_imgs, seq_acts = [], [], []
-    for path in paths:
-        observations = path['observations']
-        images = path['images']
-        actions = path['actions']
-        n = observations.shape[0]
+    for batch_obs, batch_imgs, batch_acts in batches:
+        seq_obs.append(batch_obs)
+        seq_imgs.append(batch_imgs)
+        seq_acts.append(batch_acts)
+    return seq_obs, seq_imgs, seq_acts
+
+def mult_wind_batches(paths, min_ws, max_ws, batch_size=64):
+    #Complete paths -> Index of windows with a random window size each
+    path_ids, starts, window_sizes = [], [], []
+    for i, path in enumerate(paths):
+        n = path['observations'].shape[0]
         t = 0
         window_size = np.random.randint(min_ws, max_ws + 1)
         while t + window_size <= n - 1: 
-            seq_obs.append(observations[t])
-            seq_imgs.append(np.array([images[t], images[t+window_size]]))
-            seq_acts.append(actions[t])
+            path_ids.append(i)
+            starts.append(t)
+            window_sizes.append(window_size)
             window_size = np.random.randint(min_ws, max_ws + 1)
             t += 1
-    
-    #List -> numpy array
-    seq_obs = np.stack(seq_obs, axis=0) # B, O
-    seq_imgs = np.stack(seq_imgs, axis=0) # B, S, H, W, C
-    seq_imgs = np.transpose(seq_imgs, (0, 1, 4, 2, 3)) # B, S, C, H, W
-    seq_acts = np.stack(seq_acts, axis=0) # B, A
+    return WindowBatches(paths, path_ids, starts, window_sizes, batch_size, validation=True)
 
-    #Shuffle inds
-    inds = np.arange(seq_obs.shape[0])
-    np.random.shuffle(inds)
-    seq_obs = seq_obs[inds]
-    seq_imgs = seq_imgs[inds]
-    seq_acts = seq_acts[inds]
+def window_batches(paths, window_size=16, batch_size=64, validation=False, reset_seed=False):
+    path_ids, starts, window_sizes = window_index(paths, window_size)
+    return WindowBatches(paths, path_ids, starts, window_sizes, batch_size, validation, \
+                         reset_seed=reset_seed)
 
-    #Split to batches
-    num_splits = seq_obs.shape[0]//batch_size
-    seq_obs = np.array_split(seq_obs, num_splits)
-    seq_imgs = np.array_split(seq_imgs, num_splits)
-    seq_acts = np.array_split(seq_acts, num_splits)
-    return seq_obs, seq_imgs, seq_acts
+#For validation
+def mult_wind_preprocessing(paths, min_ws, max_ws, batch_size=64):
+    return unzip_batches(mult_wind_batches(paths, min_ws, max_ws, batch_size))
     
 def preprocess_data(paths, window_size=16, batch_size=64, validation=False, reset_seed=False):
-    #Complete paths -> List of windows
-    seq_obs, seq_imgs, seq_acts = [], [], []
-    for path in paths:
-        observations = path['observations']
-        images = path['images']
-        actions = path['actions']
-        n = observations.shape[0]
-        t = 0
-        while t + window_size <= n - 1: 
-            if(validation):
-                #For validation data
-                #return: [current_img, goal_img] , current_obs, current_action
-                seq_obs.append(observations[t])
-                seq_imgs.append(np.array([images[t], images[t+window_size]]))
-                seq_acts.append(actions[t])
-            else:
-                seq_obs.append(observations[t: t+window_size])
-                seq_imgs.append(images[t: t+window_size])
-                seq_acts.append(actions[t: t+window_size])
-            t += 1
-    
-    #List -> numpy array
-    seq_obs = np.stack(seq_obs, axis=0) #Train = B, S, O | Val = B, O
-    seq_imgs = np.stack(seq_imgs, axis=0) #B, S, H, W, C
-    seq_imgs = np.transpose(seq_imgs, (0, 1, 4, 2, 3)) #B, S, C, H, W
-    seq_acts = np.stack(seq_acts, axis=0) #Train = B, S, A | Val = B, A
-
-    #Shuffle inds
-    if(reset_seed):
-         np.random.seed(0) #same numbers..
-    inds = np.arange(seq_obs.shape[0])
-    np.random.shuffle(inds)
-    seq_obs = seq_obs[inds]
-    seq_imgs = seq_imgs[inds]
-    seq_acts = seq_acts[inds]
-
-    #Split to batches
-    num_splits = seq_obs.shape[0]//batch_size
-    seq_obs = np.array_split(seq_obs, num_splits)
-    seq_imgs = np.array_split(seq_imgs, num_splits)
-    seq_acts = np.array_split(seq_acts, num_splits)
-    return seq_obs, seq_imgs, seq_acts
+    return unzip_batches(window_batches(paths, window_size, batch_size, validation, reset_seed))
 
 def path_to_batches(path, window_size=16, batch_size=64, validation=False):
     #Path-> List of batches without changing order
-    seq_obs, seq_imgs, seq_acts = [], [], []
-    observations = path['observations']
-    images = path['images']
-    actions = path['actions']
-    n = observations.shape[0]
-    t = 0
-    while t + window_size <= n - 1: 
-        if(validation):
-            seq_obs.append(observations[t])
-            seq_imgs.append(np.array([images[t], images[t+window_size]]))
-            seq_acts.append(actions[t])
-        else:
-            seq_obs.append(observations[t: t+window_size])
-            seq_imgs.append(images[t: t+window_size])
-            seq_acts.append(actions[t: t+window_size])
-        t += 1
-    
-    #List -> numpy array
-    seq_obs = np.stack(seq_obs, axis=0) #Train = B, S, O | Val = B, O
-    seq_imgs = np.stack(seq_imgs, axis=0) #B, S, H, W, C
-    seq_imgs = np.transpose(seq_imgs, (0, 1, 4, 2, 3)) #B, S, C, H, W
-    seq_acts = np.stack(seq_acts, axis=0) #Train = B, S, A | Val = B, A
-
-    #Split to batches
-    num_splits = seq_obs.shape[0]//batch_size
-    seq_obs = np.array_split(seq_obs, num_splits)
-    seq_imgs = np.array_split(seq_imgs, num_splits)
-    seq_acts = np.array_split(seq_acts, num_splits)
-    return seq_obs, seq_imgs, seq_acts
\ No newline at end of file
+    path_ids, starts, window_sizes = window_index([path], window_size)
+    return unzip_batches(WindowBatches([path], path_ids, starts, window_sizes, batch_size, \
+                                       validation, shuffle=False))
\ No newline at end of file
@@ -1,37 +1,57 @@
 import glob
+import json
 import logging
 import os
 import pickle
 import hydra
 import numpy as np
+from collections import OrderedDict
 from torch.utils.data import Dataset
+from dataset_storage import is_memmap_dir, load_memmap_paths, is_chunked_dir, load_chunked_paths
  
 logger = logging.getLogger(__name__)
 
 class BaseRelayKitchen(Dataset):
-    """ Common Relay Kitchen Class, it will be extended by other datasets """
-    def __init__(self, datasets_dir, max_window_size=32):
+    """ Common Relay Kitchen Class, it will be extended by other datasets
+
+        lazy: only the length of every file is read up front, paths are unpickled on demand
+              and kept in a LRU cache of cache_size files per worker. Memmap and chunked datasets
+              are always read on demand so the flag is ignored for them.
+    """
+    def __init__(self, datasets_dir, max_window_size=32, lazy=False, cache_size=4):
         self.datasets_dir = datasets_dir
         self.max_window_size = max_window_size
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # file idx -> path, most recently used last
         #abs_datasets_dir = os.path.join(hydra.utils.get_original_cwd(), datasets_dir)
         abs_datasets_dir = os.path.join(os.getcwd(), datasets_dir)
-        self.data_files = glob.glob(os.path.join(abs_datasets_dir, "*.pkl"))
+        self.memmap = is_memmap_dir(abs_datasets_dir)
+        self.chunked = not self.memmap and is_chunked_dir(abs_datasets_dir)
+        if self.memmap or self.chunked:
+            self.data_files = [abs_datasets_dir]  # Converted or collected with dataset_storage.py
+        else:
+            self.data_files = glob.glob(os.path.join(abs_datasets_dir, "*.pkl"))
         assert self.data_files
-        self.file_index = []  # To map from dataloader idx -> file idx
+        self.lazy = lazy and not (self.memmap or self.chunked)
+        self.file_offsets = None  # To map from dataloader idx -> file idx, seq idx
         logger.info("loading dataset.....")
         self.data = self.load_data(self.data_files)
         logger.info("finished loading dataset")
 
+    def get_file_idx(self, idx):
+        # file_offsets[i] is the first dataloader index of file i, files without windows
+        # share the offset of the next file so 'right' skips them
+        file_idx = np.searchsorted(self.file_offsets, idx, side='right') - 1
+        seq_idx = idx - self.file_offsets[file_idx]
+        return file_idx, seq_idx
+
     def getSequences(self, idx, window_size):
-        file_idx = self.file_index[idx]
-        x = self.data[file_idx]
+        file_idx, seq_idx = self.get_file_idx(idx)
+        x = self.get_path(file_idx)
         observations = x['observations']
         images = x['images']
         actions = x['actions']
         seq_obs, seq_imgs, seq_acts = [], [], []
-        # Get the first dataloader index from the file with index file_idx
-        first_dlidx_file = next(i for i, fidx in enumerate(self.file_index) if fidx == file_idx)
-        seq_idx = idx - first_dlidx_file
  
         if 'val' in self.datasets_dir:
             # For validation data
@@ -44,63 +64,126 @@ class BaseRelayKitchen(Dataset):
             seq_imgs = images[seq_idx: seq_idx + window_size]
             seq_acts = actions[seq_idx: seq_idx + window_size]
         seq_imgs = np.transpose(seq_imgs, (0, 3, 1, 2))  # Change to S, C, H, W
-        return seq_obs.astype(np.float32), seq_imgs.astype(np.float32), seq_acts.astype(np.float32)
+        # Images stay uint8, they are converted to float on the device by PlayLMP
+        assert seq_imgs.dtype == np.uint8, "images are expected as uint8 (0-255), got %s" % seq_imgs.dtype
+        seq_imgs = np.ascontiguousarray(seq_imgs)
+        return seq_obs.astype(np.float32), seq_imgs, seq_acts.astype(np.float32)
+
+    def load_file(self, data_file):
+        path = {'observations': [], 'images': [], 'actions': []}  # Only retrieve this keys
+        if os.path.getsize(data_file) > 0:  # Check if the file is not empty
+            with open(data_file, 'rb') as f:
+                data = pickle.load(f)
+                for key in path.keys():
+                    if key == "observations":
+                        path[key] = data[key][:, :9]
+                    else:
+                        path[key] = data[key]
+        return path
+
+    def get_path(self, file_idx):
+        if not self.lazy:
+            return self.data[file_idx]
+        if file_idx in self.cache:
+            self.cache.move_to_end(file_idx)
+        else:
+            self.cache[file_idx] = self.load_file(self.data_files[file_idx])
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return self.cache[file_idx]
+
+    def read_lengths(self, file_names):
+        # Lengths are stored next to the data, a file is only unpickled again if it changed
+        lengths_file = os.path.join(os.path.dirname(file_names[0]), "file_lengths.json")
+        stored = {}
+        if os.path.isfile(lengths_file):
+            with open(lengths_file, 'r') as f:
+                stored = json.load(f)
+        lengths, updated = [], False
+        for data_file in file_names:
+            name, stat = os.path.basename(data_file), os.stat(data_file)
+            key = [stat.st_size, stat.st_mtime]
+            if name not in stored or stored[name][:2] != key:
+                stored[name] = key + [len(self.load_file(data_file)["observations"])]
+                updated = True
+            lengths.append(stored[name][2])
+        if updated:
+            try:
+                with open(lengths_file, 'w') as f:
+                    json.dump(stored, f)
+            except OSError:
+                logger.warning("could not write %s" % lengths_file)
+        return lengths
 
     def load_data(self, file_names):
-        paths = []
-        for file_idx, data_file in enumerate(file_names):
-            path = {'observations': [], 'images': [], 'actions': []}  # Only retrieve this keys
-            if os.path.getsize(data_file) > 0:  # Check if the file is not empty
-                with open(data_file, 'rb') as f:
-                    data = pickle.load(f)
-                    for key in path.keys():
-                        if key == "observations":
-                            path[key] = data[key][:, :9]
-                        else:
-                            path[key] = data[key]
- 
-            # Possible initial indices in the recorded path that will be able to create a window of experience
-            # Starting in that point
-            possible_indices = path["observations"].shape[0] - self.max_window_size
-            for _ in range(possible_indices):
-                self.file_index.append(file_idx)
-            paths.append(path)
+        if self.memmap:
+            paths = load_memmap_paths(file_names[0])
+        elif self.chunked:
+            paths = load_chunked_paths(file_names[0])
+        elif self.lazy:
+            paths = None
+        else:
+            paths = [self.load_file(data_file) for data_file in file_names]
+
+        if paths is None:
+            lengths = self.read_lengths(file_names)
+        else:
+            lengths = [len(path["observations"]) for path in paths]
+        # Possible initial indices in the recorded path that will be able to create a window of experience
+        # Starting in that point
+        n_windows = [max(length - self.max_window_size, 0) for length in lengths]
+        self.file_offsets = np.concatenate(([0], np.cumsum(n_windows))).astype(np.int64)
         return paths
  
     def __len__(self):
-        return len(self.file_index)
+        return int(self.file_offsets[-1])
  
 class ConstantRelayKitchen(BaseRelayKitchen):
     """ This dataloader creates batches of a single window size """
-    def __init__(self, datasets_dir, window_size):
+    def __init__(self, datasets_dir, window_size, lazy=False, cache_size=4):
         self.window_size = window_size
-        super().__init__(datasets_dir, self.window_size)
+        super().__init__(datasets_dir, self.window_size, lazy, cache_size)
 
     def __getitem__(self, idx):
         return self.getSequences(idx, self.window_size)
 
 class PaddedRelayKitchen(BaseRelayKitchen):
-    """ This dataloader pads the window size, to the max window size """
-    def __init__(self, datasets_dir, ws_range=[16, 32]):
+    """ This dataloader pads the window size, to the max window size.
+        Training windows are padded at the end and also return the window size,
+        so PlayLMP.step can skip the padded frames.
+
+        seed: the window size of every index is drawn once from seed, so every
+              epoch sees the same windows (validation). Random every call by default.
+    """
+    def __init__(self, datasets_dir, ws_range=[16, 32], lazy=False, cache_size=4, seed=None):
         self.ws_range = ws_range
-        super().__init__(datasets_dir, ws_range[1])
+        super().__init__(datasets_dir, ws_range[1], lazy, cache_size)
+        self.window_sizes = None
+        if seed is not None:
+            self.window_sizes = np.random.RandomState(seed).randint(*ws_range, size=len(self))
  
+    #Training: (obs, imgs, acts, window_size), padded to ws_range[1]
+    #Validation: (obs, imgs, acts) as in the other datasets, [current_img, goal_img] and no padding
     def __getitem__(self, idx):
-        window_size = np.random.randint(*self.ws_range)
+        if self.window_sizes is None:
+            window_size = np.random.randint(*self.ws_range)
+        else:
+            window_size = int(self.window_sizes[idx])
         seq_obs, seq_imgs, seq_acts = self.getSequences(idx, window_size)
         if 'train' in self.datasets_dir:
             pad_size = self.ws_range[1] - window_size
-            seq_obs = np.pad(seq_obs, ((pad_size,0),(0,0)), 'constant', constant_values=0)
-            seq_acts = np.pad(seq_acts, ((pad_size,0),(0,0)), 'constant', constant_values=0)
-            seq_imgs = np.pad(seq_imgs, ((pad_size,0),(0,0),(0,0),(0,0)), 'constant', constant_values=0)
+            seq_obs = np.pad(seq_obs, ((0,pad_size),(0,0)), 'constant', constant_values=0)
+            seq_acts = np.pad(seq_acts, ((0,pad_size),(0,0)), 'constant', constant_values=0)
+            seq_imgs = np.pad(seq_imgs, ((0,pad_size),(0,0),(0,0),(0,0)), 'constant', constant_values=0)
+            return seq_obs, seq_imgs, seq_acts, window_size
         return seq_obs, seq_imgs, seq_acts
 
 class VaryingRelayKitchen(BaseRelayKitchen):
     """ This dataloader creates batches of a different window size
         every batch. """
-    def __init__(self, datasets_dir, ws_range=[16, 32]):
+    def __init__(self, datasets_dir, ws_range=[16, 32], lazy=False, cache_size=4):
         self.ws_range = ws_range
-        super().__init__(datasets_dir, ws_range[1])
+        super().__init__(datasets_dir, ws_range[1], lazy, cache_size)
 
     def __getitem__(self, idx):
         return self.getSequences(*idx)
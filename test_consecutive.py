@@ -2,7 +2,7 @@ import numpy as np
 import glob
 import pickle
 import matplotlib.pyplot as plt
-from networks.play_lmp import PlayLMP
+from networks.play_lmp import PlayLMP, RolloutState
 import torch
 import cv2
 import os
@@ -16,45 +16,48 @@ import argparse
 from tqdm import tqdm
 import keyboard
 import time 
-from utils.test_utils import viewer
+from utils.test_utils import Viewer, GoalCache
+from utils.rendering import FrameRenderer
 
 def test_model_seq_goals(model, goal_lst, env_steps = 1000, new_plan_frec = 20 , \
-    show_video = False,save_video=False, save_folder="./analysis/videos/model_trials/", save_filename="video.mp4"):
+    show_video = False,save_video=False, save_folder="./analysis/videos/model_trials/", save_filename="video.mp4", \
+    goal_cache=None, stateful_decoding=True):
     print("Test subsequent goals... press n to change goal")
     print("Goal list:", goal_lst)
     new_goal = goal_lst.pop(0)
     print("first goal: ", new_goal)
-    #load goal
-    goal = plt.imread(new_goal) #read as RGB, blue shelfs
-    goal = np.rint(goal*255).astype(int) #change to model scale
+    #load goal, every goal image is only encoded once
+    if goal_cache is None:
+        goal_cache = GoalCache(model)
+    goal, goal_encoding = goal_cache.get(new_goal)
 
     #Env init
     gym_env = gym.make('kitchen_relax-v1')
     env = gym_env.env
     
     s = env.reset()
-    #init viewer utility
+    #init viewer utility, the video is written while the model runs
     FPS = 10
     render_skip = max(1, round(1. / \
         (FPS * env.sim.model.opt.timestep * env.frame_skip)))
-    viewer(env, mode='initialize')
+    if(save_video):
+        if not os.path.exists(save_folder):
+            os.makedirs(save_folder)
+    viewer = Viewer(env, save_folder + save_filename if save_video else None, show=show_video)
+    rollout = RolloutState(goal_encoding, new_plan_frec, stateful_decoding)
+    renderer = FrameRenderer(env) #headless 300x300 model input
 
     #take actions
     for i in tqdm(range(env_steps)):
-        curr_img = env.render(mode='rgb_array')   
-        curr_img = cv2.resize(curr_img , (300,300))
+        curr_img = renderer.render() #(300, 300, 3)
         
-        current_and_goal = np.stack((curr_img, goal) , axis=0) #(2, 300, 300, 3)
-        current_and_goal = np.expand_dims(current_and_goal.transpose(0,3,1,2), axis=0) #(1, 2, 3, 300, 300)
+        current_img = np.expand_dims(curr_img.transpose(2,0,1), axis=0) #(1, 3, 300, 300)
         current_obs = np.expand_dims(s[:9], axis=0) #(1,9)
 
-        #prediction
-        if(i % new_plan_frec == 0):
-            plan = model.get_pp_plan(current_obs,current_and_goal)
-        action = model.predict_with_plan(current_obs, current_and_goal, plan).squeeze() #(9)
+        #prediction, a new plan is sampled every new_plan_frec steps
+        action, _ = model.rollout_step(current_obs, current_img, rollout)
+        action = action.squeeze() #(9)
         s , r, _, _ = env.step(action.cpu().detach().numpy())
-        if(i % render_skip == 0):
-            viewer(env, mode='render', render=show_video)
         
         ############ change goal #############
         if keyboard.is_pressed("n"):
@@ -63,8 +66,8 @@ def test_model_seq_goals(model, goal_lst, env_steps = 1000, new_plan_frec = 20 ,
                 print("Changing goal..")
                 print("New goal", new_goal)
                 print("Goals left:", goal_lst)
-                goal = plt.imread(new_goal) #read as RGB, blue shelfs
-                goal = np.rint(goal*255).astype(int) #change to model scale
+                goal, goal_encoding = goal_cache.get(new_goal)
+                rollout.set_goal(goal_encoding) #plan again for the new goal
                 time.sleep(1)
                 print("Continue execution..")
             else:
@@ -75,12 +78,9 @@ def test_model_seq_goals(model, goal_lst, env_steps = 1000, new_plan_frec = 20 ,
         ########################################
 
         if(i % render_skip == 0):
-            viewer(env, mode='render', render=show_video)
+            viewer.render()
     #Save model
-    if(save_video):
-        if not os.path.exists(save_folder):
-            os.makedirs(save_folder)
-        viewer(env, mode='save', filename=save_folder + save_filename)
+    viewer.close()
     env.close()
 
 def test_subsequent(model_name, n_mixtures, use_logistics, goal_list, video_name, sample_new_plan=1, n_runs=5):
@@ -88,6 +88,7 @@ def test_subsequent(model_name, n_mixtures, use_logistics, goal_list, video_name
     model_file_path = './models/%s.pth'%model_name
     model = PlayLMP(num_mixtures=n_mixtures, use_logistics=use_logistics)
     model.load(model_file_path)
+    goal_cache = GoalCache(model)
 
     #run and save video
     #press n to switch to next goal in list#
@@ -97,7 +98,7 @@ def test_subsequent(model_name, n_mixtures, use_logistics, goal_list, video_name
         #goals to be exectured in sequence
         goal_lst = ["./data/goals/"+goal+".png" for goal in goal_list]
         test_model_seq_goals(model, goal_lst, env_steps = 600, new_plan_frec = sample_new_plan , \
-                         show_video = True, save_video = True, save_filename=video_name)
+                         show_video = True, save_video = True, save_filename=video_name, goal_cache=goal_cache)
 
 if __name__ == '__main__':
     #model init
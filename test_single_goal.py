@@ -2,7 +2,7 @@ import numpy as np
 import glob
 import pickle
 import matplotlib.pyplot as plt
-from networks.play_lmp import PlayLMP
+from networks.play_lmp import PlayLMP, RolloutState
 import torch
 import cv2
 import os
@@ -16,7 +16,8 @@ import argparse
 from tqdm import tqdm
 import keyboard
 import time 
-from utils.test_utils import init_env, viewer
+from utils.test_utils import init_env, Viewer, GoalCache
+from utils.rendering import FrameRenderer
 
 #Reproduce actions from .pkl into environment and save video
 def parse_reprod_act_vid():
@@ -48,48 +49,49 @@ def parse_reprod_act_vid():
     reproduce_file_actions(eval_filename, show_video=False, save_video=True, save_filename = "friday_microwave_topknob_bottomknob_slide_eval_demo.mp4")
 
 def test_model(model, goal_path, show_goal=False, env_steps = 1000, new_plan_frec = 20 ,\
-     show_video = False, save_video=False, save_folder="./analysis/videos/model_trials/", save_filename="video.mp4"):
-    #load goal
-    goal = plt.imread(goal_path)#read as RGB, blue shelfs
+     show_video = False, save_video=False, save_folder="./analysis/videos/model_trials/", save_filename="video.mp4", \
+     goal_cache=None, stateful_decoding=True):
+    #load goal, the goal image is only encoded once
+    if goal_cache is None:
+        goal_cache = GoalCache(model)
+    goal, goal_encoding = goal_cache.get(goal_path)
     if(show_goal):
         plt.axis('off')
         plt.suptitle("Goal")
         plt.imshow(goal)
         plt.show()
-    goal = np.rint(goal*255).astype(int) #change to model scale
     #Env init
     gym_env = gym.make('kitchen_relax-v1')
     env = gym_env.env
     
     s = env.reset()
-    #init viewer utility
+    #init viewer utility, the video is written while the model runs
     FPS = 10
     render_skip = max(1, round(1. / \
         (FPS * env.sim.model.opt.timestep * env.frame_skip)))
-    viewer(env, mode='initialize')
+    if(save_video):
+        if not os.path.exists(save_folder):
+            os.makedirs(save_folder)
+    viewer = Viewer(env, save_folder + save_filename if save_video else None, show=show_video)
+    rollout = RolloutState(goal_encoding, new_plan_frec, stateful_decoding)
+    renderer = FrameRenderer(env) #headless 300x300 model input
 
     #take actions
     for i in tqdm(range(env_steps)):
-        curr_img = env.render(mode='rgb_array')   
-        curr_img = cv2.resize(curr_img , (300,300))
+        curr_img = renderer.render() #(300, 300, 3)
         
-        current_and_goal = np.stack((curr_img, goal) , axis=0) #(2, 300, 300, 3)
-        current_and_goal = np.expand_dims(current_and_goal.transpose(0,3,1,2), axis=0) #(1, 2, 3, 300, 300)
+        current_img = np.expand_dims(curr_img.transpose(2,0,1), axis=0) #(1, 3, 300, 300)
         current_obs = np.expand_dims(s[:9], axis=0) #(1,9)
 
-        #prediction
-        if(i % new_plan_frec == 0):
-            plan = model.get_pp_plan(current_obs,current_and_goal)
-        action = model.predict_with_plan(current_obs, current_and_goal, plan).squeeze() #(9)
+        #prediction, a new plan is sampled every new_plan_frec steps
+        action, _ = model.rollout_step(current_obs, current_img, rollout)
+        action = action.squeeze() #(9)
         s , r, _, _ = env.step(action.cpu().detach().numpy())
         if(i % render_skip == 0):
-            viewer(env, mode='render', render=show_video)
+            viewer.render()
 
     #Save model
-    if(save_video):
-        if not os.path.exists(save_folder):
-            os.makedirs(save_folder)
-        viewer(env, mode='save', filename=save_folder + save_filename)
+    viewer.close()
     env.close()
 
 def test(model_name, n_mixtures, use_logistics, \
@@ -100,6 +102,7 @@ def test(model_name, n_mixtures, use_logistics, \
     model_file_path = './models/%s.pth'%model_name
     model = PlayLMP(num_mixtures=n_mixtures, use_logistics=use_logistics)
     model.load(model_file_path)
+    goal_cache = GoalCache(model)
 
     #name to store folder videos on save_parent_dir
     names = [ g.split('/')[-1] for g in goals]
@@ -117,7 +120,7 @@ def test(model_name, n_mixtures, use_logistics, \
             video_name = "%s_npf_%d_"%(model_name, sample_new_plan)+name+"(%d).mp4"%i
             test_model(model, goal_file_path, env_steps=400, new_plan_frec=sample_new_plan, \
                         save_video=save_video, show_video = show_video,\
-                        save_folder=save_parent_dir+name+"/", save_filename=video_name)
+                        save_folder=save_parent_dir+name+"/", save_filename=video_name, goal_cache=goal_cache)
 
 if __name__ == '__main__':
     #----------- Test ------------#
@@ -0,0 +1,30 @@
+import pytest
+import torch
+import torch.nn.functional as F
+from networks.play_lmp import PlayLMP
+from utils.benchmark import random_batch
+import utils.constants as constants
+
+#Loss and gradients of PlayLMP.step on cpu with bfloat16 autocast against fp32 on the same weights,
+#lr=0 so the optimizer step does not change them between both runs
+def test_bf16_step_matches_fp32():
+    torch.manual_seed(0)
+    model = PlayLMP(lr=0, num_mixtures=constants.N_MIXTURES, use_logistics=constants.USE_LOGISTICS, \
+                    amp_dtype="bfloat16", device="cpu")
+    obs, imgs, acts = random_batch(batch_size=2, window_size=4)
+    vision_dtypes = []
+    model.vision.register_forward_hook(lambda module, inputs, output: vision_dtypes.append(output.dtype))
+    results = {}
+    for use_amp in [False, True]:
+        model.use_amp = use_amp
+        torch.manual_seed(1) #same plan sample
+        total_loss, _, _ = model.step(obs, imgs, acts)
+        grads = [p.grad.flatten() for net in [model.plan_proposal, model.action_decoder] for p in net.parameters()]
+        results[use_amp] = (total_loss.item(), torch.cat(grads))
+    assert vision_dtypes == [torch.float32, torch.bfloat16]
+
+    (loss, grads), (amp_loss, amp_grads) = results[False], results[True]
+    assert torch.isfinite(amp_grads).all()
+    assert amp_loss == pytest.approx(loss, rel=2e-2)
+    assert F.cosine_similarity(grads, amp_grads, dim=0).item() > 0.99
+    assert (amp_grads.norm() / grads.norm()).item() == pytest.approx(1, rel=5e-2)
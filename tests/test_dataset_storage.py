@@ -0,0 +1,61 @@
+import os
+import resource
+import numpy as np
+import pytest
+from dataset_storage import ChunkedEpisodeWriter, load_chunked_paths
+from relay_kitchen_dataset import ConstantRelayKitchen
+
+N_EPISODES, LENGTH, CHUNK_SIZE, WINDOW_SIZE = 100, 40, 16, 8
+
+def write_episodes(datasets_dir, compress):
+    rng = np.random.RandomState(0)
+    episodes = []
+    for i in range(N_EPISODES):
+        episode = {'observations': rng.randn(LENGTH, 30), 'images': rng.randint(0, 256, (LENGTH, 8, 8, 3), dtype=np.uint8),
+                   'actions': rng.randn(LENGTH, 9)}
+        writer = ChunkedEpisodeWriter(datasets_dir, "episode_%03d" % i, CHUNK_SIZE, compress)
+        for obs, img, act in zip(episode['observations'], episode['images'], episode['actions']):
+            writer.append(observations=obs, images=img, actions=act)
+        writer.close()
+        episodes.append(episode)
+    return episodes
+
+def open_files():
+    return len(os.listdir("/proc/self/fd"))
+
+#Random windows of more episodes than the cache holds, with a file descriptor limit below
+#episodes x keys: the loaded chunks of all the episodes share one bounded cache
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="needs /proc to count open files")
+@pytest.mark.parametrize("compress", [False, True])
+def test_chunked_random_windows_bounded_cache(tmp_path, compress):
+    datasets_dir = str(tmp_path / "chunked")
+    episodes = write_episodes(datasets_dir, compress)
+    dataset = ConstantRelayKitchen(datasets_dir, WINDOW_SIZE)
+    cache = dataset.data[0]['images'].cache
+    assert all(array.cache is cache for path in dataset.data for array in path.values())
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    start_files = open_files()
+    resource.setrlimit(resource.RLIMIT_NOFILE, (start_files + 2 * cache.cache_size, hard))
+    try:
+        for idx in np.random.RandomState(0).permutation(len(dataset)):
+            obs, imgs, acts = dataset[idx]
+            file_idx, seq_idx = dataset.get_file_idx(idx)
+            window = slice(seq_idx, seq_idx + WINDOW_SIZE)
+            np.testing.assert_allclose(obs, episodes[file_idx]['observations'][window, :9].astype(np.float32))
+            np.testing.assert_array_equal(imgs, episodes[file_idx]['images'][window].transpose(0, 3, 1, 2))
+            np.testing.assert_allclose(acts, episodes[file_idx]['actions'][window].astype(np.float32))
+            assert len(cache) <= cache.cache_size
+            assert open_files() <= start_files + cache.cache_size
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+def test_chunked_paths_cache_size(tmp_path):
+    datasets_dir = str(tmp_path / "chunked")
+    write_episodes(datasets_dir, compress=False)
+    paths = load_chunked_paths(datasets_dir, cache_size=4)
+    for path in paths:
+        path['images'][CHUNK_SIZE - 2: CHUNK_SIZE + 2]
+    cache, episode_dir = paths[0]['images'].cache, paths[-1]['images'].episode_dir
+    assert len(cache) == 4
+    assert list(cache.chunks.keys())[-2:] == [(episode_dir, 'images', 0), (episode_dir, 'images', 1)]
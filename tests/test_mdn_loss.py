@@ -0,0 +1,67 @@
+import math
+import pytest
+import torch
+from networks.action_decoder_network import MDN
+
+#Previous MDN.loss in probability space, eps is the old floor of the likelihood
+def reference_loss(mdn, pi, sigma, mu, target, mask=None, eps=1e-7):
+    prob = pi * mdn.gaussian_probability(sigma, mu, target) #b, s, k
+    nll = -torch.log(torch.sum(prob, dim=-1) + eps) #b, s
+    if mask is None:
+        return torch.mean(nll)
+    return torch.sum(nll * mask) / torch.sum(mask)
+
+def random_mixture(b=4, s=6, k=5, o=9, dtype=torch.float32, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    pi = torch.softmax(torch.randn(b, s, k, generator=g, dtype=dtype), -1)
+    sigma = torch.rand(b, s, k, o, generator=g, dtype=dtype) + 0.5 #0.5 - 1.5
+    mu = torch.randn(b, s, k, o, generator=g, dtype=dtype)
+    target = mu[:, :, 0] + 0.5 * torch.randn(b, s, o, generator=g, dtype=dtype)
+    return pi, sigma, mu, target
+
+@pytest.mark.parametrize("use_mask", [False, True])
+def test_log_space_matches_probability_space(use_mask):
+    mdn = MDN(8, 9, 5)
+    mask = None
+    if use_mask:
+        mask = torch.arange(6).unsqueeze(0) < torch.tensor([6, 3, 1, 4]).unsqueeze(1)
+    #Exact without the old floor in float64
+    pi, sigma, mu, target = random_mixture(dtype=torch.float64)
+    loss = mdn.loss(pi, sigma, mu, target, mask=mask)
+    assert torch.allclose(loss, reference_loss(mdn, pi, sigma, mu, target, mask, eps=0), rtol=1e-10, atol=0)
+    #Same values and gradients in float32, the 1e-7 floor is left out as the densities are ~1e-4
+    inputs = [x.float().requires_grad_() for x in (pi, sigma, mu)]
+    target = target.float()
+    loss = mdn.loss(*inputs, target, mask=mask)
+    grads = torch.autograd.grad(loss, inputs)
+    reference = reference_loss(mdn, *inputs, target, mask, eps=0)
+    reference_grads = torch.autograd.grad(reference, inputs)
+    assert torch.allclose(loss, reference, rtol=1e-5, atol=1e-5)
+    for grad, reference_grad in zip(grads, reference_grads):
+        assert torch.allclose(grad, reference_grad, rtol=1e-4, atol=1e-5)
+
+#Targets far from every component: the old likelihood underflows to 0, the loss saturates
+#at -log(1e-7) (inf without the floor) and has no gradient
+def test_far_targets_stay_finite():
+    mdn = MDN(8, 9, 5)
+    pi, sigma, mu, target = random_mixture()
+    target = mu[:, :, 0] + 100 * sigma[:, :, 0]
+    sigma.requires_grad_()
+    reference = reference_loss(mdn, pi, sigma, mu, target)
+    assert reference.item() == pytest.approx(-math.log(1e-7))
+    assert torch.isinf(reference_loss(mdn, pi, sigma, mu, target, eps=0))
+    loss = mdn.loss(pi, sigma, mu, target)
+    grad, = torch.autograd.grad(loss, sigma)
+    assert torch.isfinite(loss) and loss.item() > 1e3
+    assert torch.isfinite(grad).all() and grad.abs().sum() > 0
+
+#Tiny variances with the target on the mean: the old density overflows to inf and the loss is -inf
+def test_tiny_sigmas_stay_finite():
+    mdn = MDN(8, 9, 5)
+    pi, sigma, mu, _ = random_mixture()
+    sigma = torch.full_like(sigma, 1e-30)
+    target = mu[:, :, 0]
+    assert not torch.isfinite(reference_loss(mdn, pi, sigma, mu, target))
+    loss = mdn.loss(pi, sigma, mu, target)
+    assert torch.isfinite(loss)
+    assert loss.item() < 0 #density far above 1
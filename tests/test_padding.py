@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+import torch
+from networks.play_lmp import PlayLMP
+from utils.benchmark import random_batch
+import utils.constants as constants
+
+#A batch padded after the windows with lengths gives the loss of the same windows unpadded,
+#lr=0 so the optimizer step does not change the weights between both runs
+def test_padded_step_matches_unpadded():
+    torch.manual_seed(0)
+    model = PlayLMP(lr=0, num_mixtures=constants.N_MIXTURES, use_logistics=constants.USE_LOGISTICS, device="cpu")
+    obs, imgs, acts = random_batch(batch_size=2, window_size=4)
+    pad = lambda x: np.concatenate([x, np.zeros((2, 2) + x.shape[2:], dtype=x.dtype)], axis=1)
+    torch.manual_seed(1)
+    total_loss, mix_loss, kl_loss = model.step(obs, imgs, acts)
+    torch.manual_seed(1)
+    padded_total_loss, padded_mix_loss, padded_kl_loss = model.step(pad(obs), pad(imgs), pad(acts), lengths=[4, 4])
+    assert padded_mix_loss.item() == pytest.approx(mix_loss.item(), rel=1e-4)
+    assert padded_kl_loss.item() == pytest.approx(kl_loss.item(), rel=1e-4)
+    assert padded_total_loss.item() == pytest.approx(total_loss.item(), rel=1e-4)
@@ -0,0 +1,17 @@
+import numpy as np
+from networks.play_lmp import PlayLMP
+from parallel_evaluation import evaluate, FakeKitchenEnv
+import utils.constants as constants
+
+#3 goals x 3 runs on 2 envs: the goals share groups and the last group has a single episode
+def test_evaluate_fake_env():
+    model = PlayLMP(num_mixtures=constants.N_MIXTURES, use_logistics=constants.USE_LOGISTICS, device="cpu")
+    rng = np.random.RandomState(0)
+    goals = {name: rng.randint(0, 256, (300, 300, 3), dtype=np.uint8) for name in ["microwave", "bottomknob", "hinge"]}
+    results, stats = evaluate(model, goals, FakeKitchenEnv, n_envs=2, n_runs=3, env_steps=2)
+    assert list(results.keys()) == list(goals.keys())
+    for episodes in results.values():
+        assert len(episodes) == 3
+        for episode in episodes:
+            assert episode == {'return': 0., 'done': False, 'done_step': None, 'env_info': {}}
+    assert stats['episodes'] == 9
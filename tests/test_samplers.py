@@ -0,0 +1,81 @@
+import torch
+from networks.action_decoder_network import MDN
+from networks.logistic_policy_network import LogisticPolicyNetwork
+
+#Previous LogisticPolicyNetwork.sample, the component is selected with a one-hot product
+def reference_logistic_sample(logit_probs, log_scales, means):
+    r1, r2 = 1e-5, 1.-1e-5
+    temp = (r1 - r2) * torch.rand(means.shape, device=means.device) + r2
+    temp = logit_probs - torch.log(-torch.log(temp))
+    argmax = torch.argmax(temp, -1)
+    dist = torch.eye(means.shape[-1], device=means.device)[argmax]
+    log_scales = (dist * log_scales).sum(dim=-1)
+    means = (dist * means).sum(dim=-1)
+    scales = torch.exp(log_scales)
+    u = (r1 - r2) * torch.rand(means.shape, device=means.device) + r2
+    actions = means + scales * (torch.log(u) - torch.log(1. - u))
+    return actions.clamp(-0.999, 0.999)
+
+#Previous MDN.sample, one component per state without the n_samples dimension
+def reference_mdn_sample(pi, sigma, mu):
+    sel_gaussians = torch.multinomial(pi.view(-1, pi.shape[-1]), 1)
+    sel_gaussians = sel_gaussians.view(mu.shape[0], mu.shape[1], 1, 1).expand(-1, -1, -1, mu.shape[-1])
+    sel_mu = torch.gather(mu, 2, sel_gaussians).squeeze(2)
+    sel_sigma = torch.gather(sigma, 2, sel_gaussians).squeeze(2)
+    return torch.normal(sel_mu, sel_sigma)
+
+#Mixtures with means well inside the action range, so the clamping does not move the mean
+def logistic_mixture(b=2, s=3, a=9, n_dist=10):
+    g = torch.Generator().manual_seed(0)
+    logit_probs = torch.softmax(torch.randn(b, s, a, n_dist, generator=g) * 2, -1)
+    log_scales = torch.full((b, s, a, n_dist), -4.)
+    means = torch.rand(b, s, a, n_dist, generator=g) - 0.5
+    return logit_probs, log_scales, means
+
+def mdn_mixture(b=2, s=3, k=5, o=9):
+    g = torch.Generator().manual_seed(0)
+    pi = torch.softmax(torch.randn(b, s, k, generator=g) * 2, -1)
+    sigma = torch.rand(b, s, k, o, generator=g) * 0.1 + 0.01
+    mu = torch.randn(b, s, k, o, generator=g)
+    return pi, sigma, mu
+
+def test_logistic_sample_matches_one_hot_reference():
+    policy = LogisticPolicyNetwork(10)
+    logit_probs, log_scales, means = logistic_mixture()
+    #Same random draws in the same order, so the same actions for a seed
+    torch.manual_seed(1)
+    actions = policy.sample(logit_probs, log_scales, means)
+    torch.manual_seed(1)
+    assert torch.equal(actions, reference_logistic_sample(logit_probs, log_scales, means))
+    assert actions.shape == (2, 3, 9)
+
+    #n_samples draws, the deterministic mean and the reference all agree on the mixture mean
+    torch.manual_seed(2)
+    samples = policy.sample(logit_probs, log_scales, means, n_samples=20000)
+    torch.manual_seed(3)
+    reference = torch.stack([reference_logistic_sample(logit_probs, log_scales, means) for _ in range(20000)])
+    mean = policy.sample(logit_probs, log_scales, means, deterministic=True)
+    assert samples.shape == (20000, 2, 3, 9)
+    assert torch.allclose(samples.mean(0), reference.mean(0), atol=0.02)
+    assert torch.allclose(samples.mean(0), mean, atol=0.02)
+    assert torch.allclose(reference.mean(0), mean, atol=0.02)
+
+def test_mdn_sample_matches_reference():
+    mdn = MDN(8, 9, 5)
+    pi, sigma, mu = mdn_mixture()
+    torch.manual_seed(1)
+    sample = mdn.sample(pi, sigma, mu)
+    assert sample.shape == (2, 3, 9)
+    one_state = mdn.sample(pi[:1, :1], sigma[:1, :1], mu[:1, :1])
+    assert one_state.shape == (1, 1, 9) #the old squeeze dropped the batch dims
+
+    torch.manual_seed(2)
+    samples = mdn.sample(pi, sigma, mu, n_samples=20000)
+    torch.manual_seed(3)
+    reference = torch.stack([reference_mdn_sample(pi, sigma, mu) for _ in range(20000)])
+    mean = mdn.sample(pi, sigma, mu, deterministic=True)
+    assert samples.shape == (20000, 2, 3, 9)
+    assert torch.allclose(samples.mean(0), reference.mean(0), atol=0.05)
+    assert torch.allclose(samples.mean(0), mean, atol=0.05)
+    assert torch.allclose(reference.mean(0), mean, atol=0.05)
+    assert torch.allclose(samples.std(0), reference.std(0), atol=0.05)
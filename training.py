@@ -1,7 +1,8 @@
 from networks.play_lmp import PlayLMP
 from torch.utils.tensorboard import SummaryWriter
-from preprocessing import read_data, preprocess_data, get_filenames, load_data, mult_wind_preprocessing
+from preprocessing import read_data, get_filenames, load_data, window_batches, mult_wind_batches, unzip_batches
 import utils.constants as constants
+from utils.async_eval import AsyncEvaluator, log_validation
 import numpy as np
 from datetime import datetime
 import argparse
@@ -10,6 +11,9 @@ if __name__ == "__main__":
     #----------- Parser ------------#
     parser = argparse.ArgumentParser(description='some description')
     parser.add_argument('--exp_name', dest='exp_name', type=str, default='10_logistic_multitask')
+    parser.add_argument('--amp', dest='amp', action='store_true', default=constants.USE_AMP)
+    parser.add_argument('--amp_dtype', dest='amp_dtype', type=str, default=constants.AMP_DTYPE, \
+                        choices=['float16', 'bfloat16'])
     args = parser.parse_args()
     print(args)
     #-------------------------------#
@@ -18,7 +22,7 @@ if __name__ == "__main__":
     # ------------ Initialization ------------ #
     writer = SummaryWriter(summary_name)
     play_lmp = PlayLMP(constants.LEARNING_RATE, constants.BETA, \
-                       constants.N_MIXTURES, constants.USE_LOGISTICS)
+                       constants.N_MIXTURES, constants.USE_LOGISTICS, args.amp, args.amp_dtype)
     
     # ------------ Hyperparams ------------ #
     epochs = constants.N_EPOCH
@@ -33,18 +37,19 @@ if __name__ == "__main__":
     # ------------ Validation data loading ------------ #
     # Validation data
     validation_paths = read_data("./data/validation")
-    val_obs, val_imgs, val_acts = preprocess_data(validation_paths, window_size, val_batch_size, True)
-    #val_obs, val_imgs, val_acts = mult_wind_preprocessing(validation_paths, min_ws, max_ws, val_batch_size)
+    val_batches = window_batches(validation_paths, window_size, val_batch_size, True)
+    #val_batches = mult_wind_batches(validation_paths, min_ws, max_ws, val_batch_size)
     #Note when preprocesing validation data we return 
     #[current_img, goal_img] , current_obs, current_action
     #then val_imgs=(batch,2,3,300,300), val_acts = (batch,9), val_obs = (batch,9)
-    val_obs, val_imgs, val_acts = val_obs[:5], val_imgs[:5], val_acts[:5] # Keep only 5 batches (Memory)
+    val_obs, val_imgs, val_acts = unzip_batches(val_batches[i] for i in range(min(5, len(val_batches)))) # Keep only 5 batches (Memory)
     print("Validation, number of batches:", len(val_obs))
     print("Validation, batch size:", val_obs[0].shape[0])
 
+    evaluator = AsyncEvaluator(play_lmp, list(zip(val_obs, val_imgs, val_acts)), exp_name)
+
     # ------------ Training ------------ #
     batch = 0
-    best_val_accuracy, best_val_loss = 0, float('inf')
     for epoch in range(epochs):
         training_filenames = get_filenames("./data/training")
         # ------------ Filenames loop ------------ #
@@ -55,45 +60,30 @@ if __name__ == "__main__":
             print("Reading training data ...")
             training_paths = load_data(curr_filenames)
             #window_size = np.random.randint(min_ws, max_ws + 1)
-            train_obs, train_imgs, train_acts = preprocess_data(training_paths, window_size, batch_size)
-            print("Training, number of batches:", len(train_obs))
-            print("Training, batch size:", train_obs[0].shape[0])
+            #Windows are gathered per batch, only the raw paths are kept in memory
+            train_batches = window_batches(training_paths, window_size, batch_size)
+            print("Training, number of batches:", len(train_batches))
+            print("Training, batch size:", len(train_batches.batch_inds[0]))
 
             # ------------ Batch training loop ------------ #
-            while len(train_obs) > 0:
-                batch_obs, batch_imgs, batch_acts = train_obs.pop(), train_imgs.pop(), train_acts.pop()
+            for batch_obs, batch_imgs, batch_acts in train_batches:
                 # STEP
                 training_error, mix_loss, kl_loss = play_lmp.step(batch_obs, batch_imgs, batch_acts)
                 
                 # ------------ Evaluation ------------ #
                 if(batch % eval_freq == 0):
-                    val_accuracy, val_mix_loss = 0, 0
-                    # For every batch in val_data
-                    for i in range(len(val_obs)):
-                        batch_accuracy, batch_mix_loss = play_lmp.predict_eval(val_obs[i], val_imgs[i], val_acts[i])
-                        val_mix_loss += batch_mix_loss
-                        val_accuracy += batch_accuracy
-                    val_accuracy /= len(val_obs)
-                    val_mix_loss /= len(val_obs)
-                    #Save only the best models
-                    if(val_accuracy > best_val_accuracy):
-                        best_val_accuracy = val_accuracy
-                        file_name = "./models/%s_bestacc.pth" % (exp_name)
-                        play_lmp.save(file_name)
-                        
-                    if(val_mix_loss < best_val_loss):
-                        best_val_loss = val_mix_loss
-                        file_name = "./models/%s_bestloss.pth" % (exp_name)
-                        play_lmp.save(file_name)
+                    #Validation and checkpoints run on a snapshot in the background
+                    if not evaluator.submit(batch):
+                        print("Batch: %d, previous validation still running, skipped" % batch)
                     
                     #Log to tensorboard
                     writer.add_scalar('train/total_loss', training_error, batch)
                     writer.add_scalar('train/mixture_loss', mix_loss, batch)
                     writer.add_scalar('train/KL_div', kl_loss, batch)
-                    writer.add_scalar('validation/mixture_loss', val_mix_loss, batch)
-                    writer.add_scalar('validation/accuracy', val_accuracy, batch)
-                    print("Batch: %d, training error: %.2f, validation accuracy: %.2f" % (batch, training_error, val_accuracy))
+                    print("Batch: %d, training error: %.2f" % (batch, training_error))
+                log_validation(writer, evaluator.poll())
                 batch += 1  
 
             #print("Train cycle ...")
         print("Finished " + str(epoch + 1) + " epoch")
+    log_validation(writer, evaluator.close())
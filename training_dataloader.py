@@ -1,7 +1,8 @@
 from networks.play_lmp import PlayLMP
 from torch.utils.tensorboard import SummaryWriter
-from data_module import RelayKitchenDataModule
+from data_module import RelayKitchenDataModule, DevicePrefetcher
 import utils.constants as constants
+from utils.async_eval import AsyncEvaluator, log_validation
 import numpy as np
 from datetime import datetime
 import argparse
@@ -10,6 +11,9 @@ if __name__ == "__main__":
     #----------- Parser ------------#
     parser = argparse.ArgumentParser(description='some description')
     parser.add_argument('--exp_name', dest='exp_name', type=str, default='10_logistic_multitask')
+    parser.add_argument('--amp', dest='amp', action='store_true', default=constants.USE_AMP)
+    parser.add_argument('--amp_dtype', dest='amp_dtype', type=str, default=constants.AMP_DTYPE, \
+                        choices=['float16', 'bfloat16'])
     args = parser.parse_args()
     print(args)
     #-------------------------------#
@@ -18,7 +22,7 @@ if __name__ == "__main__":
     # ------------ Initialization ------------ #
     writer = SummaryWriter(summary_name)
     play_lmp = PlayLMP(constants.LEARNING_RATE, constants.BETA, \
-                       constants.N_MIXTURES, constants.USE_LOGISTICS)
+                       constants.N_MIXTURES, constants.USE_LOGISTICS, args.amp, args.amp_dtype)
     
     # ------------ Hyperparams ------------ #
     epochs = constants.N_EPOCH
@@ -35,44 +39,30 @@ if __name__ == "__main__":
     module = RelayKitchenDataModule(type="fixed", window_size=window_size, batch_size=batch_size)
     module.setup()
     val_loader = module.val_dataloader()
-    train_loader = module.train_dataloader()
+    train_loader = DevicePrefetcher(module.train_dataloader(), play_lmp.device) #overlaps the copy with step
+
+    evaluator = AsyncEvaluator(play_lmp, val_loader, exp_name)
 
     # ------------ Training ------------ #
     batch = 0
-    best_val_accuracy, best_val_loss = 0, float('inf')
     for epoch in range(epochs):
-        for batch_obs, batch_imgs, batch_acts in train_loader:
-                training_error, mix_loss, kl_loss = play_lmp.step(batch_obs, batch_imgs, batch_acts)
+        for train_batch in train_loader: # obs, imgs, acts (+ window sizes for padded batches)
+                training_error, mix_loss, kl_loss = play_lmp.step(*train_batch)
                                 
                 # ------------ Evaluation ------------ #
                 if(batch % eval_freq == 0):
-                    val_accuracy, val_mix_loss = 0, 0
-                    # For every batch in val_data
-                    for val_obs, val_imgs, val_acts in val_loader:
-                        batch_accuracy, batch_mix_loss = play_lmp.predict_eval(val_obs, val_imgs, val_acts)
-                        val_mix_loss += batch_mix_loss
-                        val_accuracy += batch_accuracy
-                    val_accuracy /= len(val_loader)
-                    val_mix_loss /= len(val_loader)
-                    #Save only the best models
-                    if(val_accuracy > best_val_accuracy):
-                        best_val_accuracy = val_accuracy
-                        file_name = "./models/%s_bestacc.pth" % (exp_name)
-                        play_lmp.save(file_name)
-                        
-                    if(val_mix_loss < best_val_loss):
-                        best_val_loss = val_mix_loss
-                        file_name = "./models/%s_bestloss.pth" % (exp_name)
-                        play_lmp.save(file_name)
+                    #Validation and checkpoints run on a snapshot in the background
+                    if not evaluator.submit(batch):
+                        print("Batch: %d, previous validation still running, skipped" % batch)
                     
                     #Log to tensorboard
                     writer.add_scalar('train/total_loss', training_error, batch)
                     writer.add_scalar('train/mixture_loss', mix_loss, batch)
                     writer.add_scalar('train/KL_div', kl_loss, batch)
-                    writer.add_scalar('validation/mixture_loss', val_mix_loss, batch)
-                    writer.add_scalar('validation/accuracy', val_accuracy, batch)
-                    print("Batch: %d, training error: %.2f, validation accuracy: %.2f" % (batch, training_error, val_accuracy))
+                    print("Batch: %d, training error: %.2f" % (batch, training_error))
+                log_validation(writer, evaluator.poll())
                 batch += 1  
 
             #print("Train cycle ...")
         print("Finished " + str(epoch + 1) + " epoch")
+    log_validation(writer, evaluator.close())
@@ -0,0 +1,92 @@
+import queue
+import threading
+import torch
+from networks.play_lmp import PlayLMP
+
+class AsyncEvaluator():
+    """ Validates a snapshot of the weights of a PlayLMP in a background thread, on its own cuda stream
+        if the model is on the gpu, and saves the best checkpoints from there. submit only copies the
+        weights, the results are logged when they are ready with poll.
+        The snapshot is a second PlayLMP without optimizer, so the networks take twice the memory """
+    def __init__(self, model, val_batches, exp_name, models_dir="./models/"):
+        self.model = model
+        self.val_batches = val_batches #(obs, imgs, acts) batches, iterated once every evaluation
+        self.exp_name = exp_name
+        self.models_dir = models_dir
+        self.shadow = PlayLMP(num_mixtures=model.num_mixtures, use_logistics=model.use_logistics, \
+                              use_amp=model.use_amp, amp_dtype=model.amp_dtype, device=model.device)
+        self.shadow.optimizer = None #only evaluated, the snapshot needs no optimizer
+        self.stream = torch.cuda.Stream(model.device) if model.device.type == 'cuda' else None
+        self.best_val_accuracy, self.best_val_loss = 0, float('inf')
+        self.results = queue.Queue()
+        self.thread = None
+        self.error = None
+
+    def busy(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    #Starts validating the current weights, returns False if the previous
+    #evaluation is still running, training never waits for it
+    def submit(self, batch):
+        if self.busy():
+            return False
+        self.shadow.load_state_dict(self.model.state_dict())
+        copied = None
+        if self.stream is not None:
+            copied = torch.cuda.Event()
+            copied.record() #the snapshot copy runs on the training stream
+        self.thread = threading.Thread(target=self.evaluate, args=(batch, copied), daemon=True)
+        self.thread.start()
+        return True
+
+    def evaluate(self, batch, copied):
+        try:
+            if self.stream is None:
+                self.validate(batch)
+            else:
+                with torch.cuda.stream(self.stream):
+                    self.stream.wait_event(copied)
+                    self.validate(batch)
+        except Exception as e:
+            self.error = e
+
+    def validate(self, batch):
+        val_accuracy, val_mix_loss, n_batches = 0, 0, 0
+        # For every batch in val_data
+        for val_obs, val_imgs, val_acts in self.val_batches:
+            batch_accuracy, batch_mix_loss = self.shadow.predict_eval(val_obs, val_imgs, val_acts)
+            val_mix_loss += batch_mix_loss.item()
+            val_accuracy += batch_accuracy
+            n_batches += 1
+        val_accuracy /= n_batches
+        val_mix_loss /= n_batches
+        #Save only the best models
+        if(val_accuracy > self.best_val_accuracy):
+            self.best_val_accuracy = val_accuracy
+            self.shadow.save(self.models_dir + "%s_bestacc.pth" % (self.exp_name))
+        if(val_mix_loss < self.best_val_loss):
+            self.best_val_loss = val_mix_loss
+            self.shadow.save(self.models_dir + "%s_bestloss.pth" % (self.exp_name))
+        self.results.put((batch, val_accuracy, val_mix_loss))
+
+    #Finished evaluations as (batch, val_accuracy, val_mix_loss)
+    def poll(self):
+        if self.error is not None:
+            raise self.error
+        results = []
+        while not self.results.empty():
+            results.append(self.results.get())
+        return results
+
+    #Waits for the running evaluation
+    def close(self):
+        if self.thread is not None:
+            self.thread.join()
+        return self.poll()
+
+#Tensorboard logging of the finished evaluations
+def log_validation(writer, results):
+    for batch, val_accuracy, val_mix_loss in results:
+        writer.add_scalar('validation/mixture_loss', val_mix_loss, batch)
+        writer.add_scalar('validation/accuracy', val_accuracy, batch)
+        print("Batch: %d, validation accuracy: %.2f" % (batch, val_accuracy))
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+Micro benchmarks of PlayLMP, run them from the root folder:
+python -m utils.benchmark amp --amp_dtype bfloat16 --device cpu
+python -m utils.benchmark loader --batch_size 8 --window_size 32 --n_iters 20 --device cpu
+python -m utils.benchmark mdn_loss --batch_size 64 --window_size 32 --device cpu
+python -m utils.benchmark logistic_loss --batch_size 64 --window_size 32 --device cpu
+python -m utils.benchmark inference --batch_size 1 --n_iters 20 --device cpu
+"""
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, Dataset
+from networks.play_lmp import PlayLMP
+from networks.action_decoder_network import MDN
+from networks.logistic_policy_network import LogisticPolicyNetwork
+from networks.inference import example_inputs, export_inference, compile_inference
+import utils.constants as constants
+
+#Random batch with the shapes and types of the training data
+def random_batch(batch_size, window_size):
+    obs = np.random.randn(batch_size, window_size, constants.N_DOF_ROBOT).astype(np.float32)
+    imgs = np.random.randint(0, 256, (batch_size, window_size, 3, 300, 300), dtype=np.uint8)
+    acts = np.random.uniform(-1, 1, (batch_size, window_size, constants.N_DOF_ROBOT)).astype(np.float32)
+    return obs, imgs, acts
+
+def synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+#Average seconds per call of fn
+def time_fn(fn, n_iters=10, n_warmup=2):
+    for _ in range(n_warmup):
+        fn()
+    synchronize()
+    start = time.perf_counter()
+    for _ in range(n_iters):
+        fn()
+    synchronize()
+    return (time.perf_counter() - start) / n_iters
+
+#Bytes of the tensors kept for the backward pass while running fn, on any device
+def saved_tensors_bytes(fn):
+    saved = {}
+    def pack(x):
+        saved[(x.data_ptr(), x.dtype, tuple(x.shape))] = x.numel() * x.element_size()
+        return x
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda x: x):
+        out = fn()
+    return out, sum(saved.values())
+
+#Forward + backward of fn, returns the result, seconds per call, saved bytes and cuda peak bytes
+def profile_loss(fn, inputs, n_iters, device):
+    def run():
+        for x in inputs:
+            x.grad = None
+        loss = fn()
+        loss.backward()
+        return loss
+    loss, saved_bytes = saved_tensors_bytes(fn)
+    peak = None
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+        run()
+        peak = torch.cuda.max_memory_allocated(device) - base
+    return loss.item(), time_fn(run, n_iters), saved_bytes, peak
+
+def print_profile(name, loss, step_time, saved_bytes, peak):
+    peak = "" if peak is None else ", cuda peak %.1f MB" % (peak / 2**20)
+    print("%s: loss %.5f, %.2f ms, saved for backward %.1f MB%s" % \
+          (name, loss, step_time * 1000, saved_bytes / 2**20, peak))
+
+#Gaussian mixture likelihood of ActionDecoderNetwork, log space loss against the previous probability space
+def benchmark_mdn_loss(batch_size=64, window_size=32, n_mixtures=constants.N_MIXTURES, n_iters=20, device=None):
+    device = torch.device(device if device is not None else ("cuda" if torch.cuda.is_available() else "cpu"))
+    mdn = MDN(2048, constants.N_DOF_ROBOT, n_mixtures).to(device)
+    torch.manual_seed(0)
+    logits = torch.randn(batch_size, window_size, n_mixtures, device=device, requires_grad=True)
+    log_sigma = torch.randn(batch_size, window_size, n_mixtures, constants.N_DOF_ROBOT, device=device)
+    log_sigma = (log_sigma * 0.5 - 1).requires_grad_()
+    mu = torch.randn(batch_size, window_size, n_mixtures, constants.N_DOF_ROBOT, device=device, requires_grad=True)
+    target = torch.rand(batch_size, window_size, constants.N_DOF_ROBOT, device=device) * 2 - 1
+    inputs = [logits, log_sigma, mu]
+
+    def prob_space_loss():
+        pi, sigma = torch.softmax(logits, -1), torch.exp(log_sigma)
+        prob = pi * mdn.gaussian_probability(sigma, mu, target)
+        return -torch.log(torch.sum(prob, dim=-1) + 1e-7).mean()
+
+    def log_space_loss():
+        return mdn.loss(torch.softmax(logits, -1), torch.exp(log_sigma), mu, target)
+
+    print("MDN loss, batch %d, window %d, %d mixtures" % (batch_size, window_size, n_mixtures))
+    print_profile("probability space", *profile_loss(prob_space_loss, inputs, n_iters, device))
+    print_profile("log space", *profile_loss(log_space_loss, inputs, n_iters, device))
+
+#Previous LogisticPolicyNetwork.loss, reference for the equivalence check
+def reference_logistic_loss(logit_probs, log_scales, means, actions, num_classes=256, log_scale_min=-7.0, \
+                            mask=None):
+    n_dist = means.shape[-1]
+    log_scales = torch.clamp(log_scales, min=log_scale_min)
+    actions = actions.unsqueeze(-1) * torch.ones(1, 1, n_dist, device=actions.device)
+    centered_actions = actions - means
+    inv_stdv = torch.exp(-log_scales)
+    plus_in = inv_stdv * (centered_actions + 1. / (num_classes - 1))
+    cdf_plus = torch.sigmoid(plus_in)
+    min_in = inv_stdv * (centered_actions - 1. / (num_classes - 1))
+    cdf_min = torch.sigmoid(min_in)
+    log_cdf_plus = plus_in - F.softplus(plus_in)
+    log_one_minus_cdf_min = -F.softplus(min_in)
+    mid_in = inv_stdv * centered_actions
+    log_pdf_mid = mid_in - log_scales - 2. * F.softplus(mid_in)
+    cdf_delta = cdf_plus - cdf_min
+    log_probs = torch.where(actions < -0.999, log_cdf_plus,
+                    torch.where(actions > 0.999, log_one_minus_cdf_min,
+                        torch.where(cdf_delta > 1e-5,
+                            torch.log(torch.clamp(cdf_delta, min=1e-12)),
+                                log_pdf_mid - np.log((num_classes - 1) / 2))))
+    log_probs = log_probs + F.log_softmax(logit_probs, dim=-1)
+    m, _ = torch.max(log_probs, dim=-1)
+    m2, _ = torch.max(log_probs, dim=-1, keepdims=True)
+    nll = -torch.sum(m + torch.log(torch.sum(torch.exp(log_probs - m2), dim=-1)), dim=-1)
+    if mask is None:
+        return nll.mean()
+    return (nll * mask).sum() / mask.sum()
+
+#Discretized logistic mixture loss of LogisticPolicyNetwork against the previous implementation,
+#checks that values and gradients match, then times forward + backward
+def benchmark_logistic_loss(batch_size=64, window_size=32, n_mixtures=constants.N_MIXTURES, n_iters=20, \
+                            device=None, compile_loss=False):
+    device = torch.device(device if device is not None else ("cuda" if torch.cuda.is_available() else "cpu"))
+    torch.manual_seed(0)
+    shape = (batch_size, window_size, constants.N_DOF_ROBOT, n_mixtures)
+    logit_probs = torch.softmax(torch.randn(shape, device=device), -1).requires_grad_()
+    log_scales = (torch.randn(shape, device=device) * 2 - 3).requires_grad_()
+    means = (torch.rand(shape, device=device) * 2 - 1).requires_grad_()
+    actions = torch.rand(batch_size, window_size, constants.N_DOF_ROBOT, device=device) * 2 - 1
+    actions[:, :, 0] = -1 #edge bins
+    actions[:, :, 1] = 1
+    inputs = [logit_probs, log_scales, means]
+
+    losses = {'reference': lambda: reference_logistic_loss(logit_probs, log_scales, means, actions)}
+    policies = [('fused', LogisticPolicyNetwork(n_mixtures))]
+    if compile_loss:
+        policies.append(('compiled', LogisticPolicyNetwork(n_mixtures, compile_loss=True)))
+    for name, policy in policies:
+        policy.to(device)
+        losses[name] = lambda policy=policy: policy.loss(logit_probs, log_scales, means, actions)
+
+    print("Logistic loss, batch %d, window %d, %d mixtures" % (batch_size, window_size, n_mixtures))
+    reference = None
+    for name, loss_fn in losses.items():
+        for x in inputs:
+            x.grad = None
+        loss = loss_fn()
+        loss.backward()
+        grads = [x.grad.clone() for x in inputs]
+        if reference is None:
+            reference = (loss.detach(), grads)
+        else:
+            max_diff = max([(g - r).abs().max().item() for g, r in zip(grads, reference[1])])
+            print("%s: loss diff %.2e, max grad diff %.2e" % (name, (loss - reference[0]).abs().item(), max_diff))
+        print_profile(name, *profile_loss(loss_fn, inputs, n_iters, device))
+
+class RandomWindows(Dataset):
+    """ Windows with the shapes of PaddedRelayKitchen, images as image_dtype """
+    def __init__(self, n_windows, window_size, image_dtype=np.uint8):
+        self.n_windows = n_windows
+        self.obs, self.imgs, self.acts = random_batch(1, window_size)
+        self.imgs = self.imgs[0].astype(image_dtype)
+
+    def __len__(self):
+        return self.n_windows
+
+    def __getitem__(self, idx):
+        return self.obs[0], self.imgs.copy(), self.acts[0]
+
+#Samples/sec of the dataloader until the images are float on the device,
+#uint8 windows converted on the device against float32 windows from the workers
+def benchmark_loader(batch_size=8, window_size=32, n_batches=20, num_workers=2, device=None):
+    device = torch.device(device if device is not None else ("cuda" if torch.cuda.is_available() else "cpu"))
+    for image_dtype in [np.float32, np.uint8]:
+        dataset = RandomWindows(batch_size * n_batches, window_size, image_dtype)
+        loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, \
+                            pin_memory=device.type == 'cuda')
+        def epoch():
+            for obs, imgs, acts in loader:
+                imgs = imgs.to(device, non_blocking=True).float()
+        epoch_time = time_fn(epoch, n_iters=1, n_warmup=1)
+        print("%s images: %.1f samples/sec, %.1f MB per window" % \
+              (np.dtype(image_dtype).name, len(dataset) / epoch_time, dataset.imgs.nbytes / 2**20))
+
+#Training throughput of PlayLMP.step in fp32 and with autocast
+def benchmark_amp(amp_dtype="bfloat16", batch_size=4, window_size=8, n_iters=5, device=None):
+    obs, imgs, acts = random_batch(batch_size, window_size)
+    for use_amp in [False, True]:
+        torch.manual_seed(0)
+        model = PlayLMP(num_mixtures=constants.N_MIXTURES, use_logistics=constants.USE_LOGISTICS, \
+                        use_amp=use_amp, amp_dtype=amp_dtype, device=device)
+        total_loss, _, _ = model.step(obs, imgs, acts)
+        step_time = time_fn(lambda: model.step(obs, imgs, acts), n_iters, n_warmup=1)
+        name = amp_dtype if use_amp else "float32"
+        print("%s: %.2f samples/sec, loss %.3f" % (name, batch_size / step_time, total_loss.item()))
+
+#Rollout step latency (get_pp_plan + predict_with_plan) of the eager PlayLMP against the exported
+#TorchScript module, loaded back from disk, and optionally torch.compile. Same seed -> same actions,
+#except for the compiled module that samples with the inductor rng
+def benchmark_inference(batch_size=1, n_iters=20, device="cpu", use_compile=False):
+    torch.manual_seed(0)
+    model = PlayLMP(num_mixtures=constants.N_MIXTURES, use_logistics=constants.USE_LOGISTICS, device=device)
+    obs, imgs, goal_encoding, _, _ = example_inputs(batch_size, model.device)
+    imgs.random_(0, 256)
+    goal_encoding = model.encode_goal(imgs)
+
+    def eager_step():
+        plan = model.get_pp_plan(obs, imgs.unsqueeze(1), goal_encoding)
+        return model.predict_with_plan(obs, imgs.unsqueeze(1), plan, goal_encoding)
+
+    file_name = os.path.join(tempfile.mkdtemp(), "inference.pt")
+    export_inference(model, file_name, batch_size)
+    steps = {'eager': eager_step}
+    for name, module in [('traced', torch.jit.load(file_name, map_location=model.device))] + \
+                        ([('compiled', compile_inference(model))] if use_compile else []):
+        steps[name] = lambda module=module: module.act(obs, imgs, goal_encoding, module.plan(obs, imgs, goal_encoding))
+
+    print("Inference step, batch %d, %s" % (batch_size, model.device))
+    reference = None
+    for name, step in steps.items():
+        with torch.no_grad():
+            torch.manual_seed(1)
+            action = step().float()
+            step_time = time_fn(step, n_iters, n_warmup=3)
+        if reference is None:
+            reference = action
+        diff = (action - reference).abs().max().item()
+        print("%s: %.2f ms, max action diff %.2e" % (name, step_time * 1000, diff))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='PlayLMP micro benchmarks')
+    parser.add_argument('benchmark', type=str, choices=['amp', 'loader', 'mdn_loss', 'logistic_loss', 'inference'])
+    parser.add_argument('--amp_dtype', type=str, default='bfloat16', choices=['float16', 'bfloat16'])
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--window_size', type=int, default=8)
+    parser.add_argument('--n_iters', type=int, default=5)
+    parser.add_argument('--device', type=str, default=None, help='cuda if available by default')
+    parser.add_argument('--compile', action='store_true', help='also benchmark the torch.compile loss / inference')
+    args = parser.parse_args()
+
+    if args.benchmark == 'amp':
+        benchmark_amp(args.amp_dtype, args.batch_size, args.window_size, args.n_iters, args.device)
+    elif args.benchmark == 'loader':
+        benchmark_loader(args.batch_size, args.window_size, args.n_iters, device=args.device)
+    elif args.benchmark == 'mdn_loss':
+        benchmark_mdn_loss(args.batch_size, args.window_size, constants.N_MIXTURES, args.n_iters, args.device)
+    elif args.benchmark == 'logistic_loss':
+        benchmark_logistic_loss(args.batch_size, args.window_size, constants.N_MIXTURES, args.n_iters, \
+                                args.device, args.compile)
+    elif args.benchmark == 'inference':
+        benchmark_inference(args.batch_size, args.n_iters, args.device or "cpu", args.compile)
@@ -22,3 +22,7 @@ EVAL_FREQ = 50 # Validate every eval_freq batches
 LEARNING_RATE = 2e-4
 BETA = 0.01
 
+# ------------ Mixed precision  ------------ #
+USE_AMP = False # Autocast PlayLMP training and inference
+AMP_DTYPE = "float16" # "float16" (GPU) or "bfloat16" (GPU/CPU)
+
@@ -0,0 +1,71 @@
+import queue
+import threading
+import cv2
+import numpy as np
+
+#Camera pose of the kitchen_relax-v1 rgb_array renders (adept_envs kitchen_multitask_v0.py)
+KITCHEN_CAMERA_POSE = dict(distance=2.2, lookat=[-0.2, .5, 2.], azimuth=70, elevation=-35)
+
+class FrameRenderer():
+    """ Renders env frames offscreen at a low resolution into a reusable (h, w, 3) uint8 buffer.
+        env.render(mode='rgb_array') creates a 1920x2560 camera on every call, here the camera is created once.
+        The training images were rendered at 1920x2560 and squashed to 300x300, so by default the camera keeps
+        the 4:3 aspect ratio (300x400) to see the same field of view. aspect=1 renders the final size directly """
+    def __init__(self, env, size=(300, 300), aspect=4/3, camera_pose=KITCHEN_CAMERA_POSE):
+        self.env = env
+        self.size = tuple(size) #height, width
+        self.render_size = (self.size[0], int(round(self.size[0] * aspect)))
+        self.frame = np.empty(self.size + (3,), dtype=np.uint8)
+        self.camera = None
+        if hasattr(env, 'sim'):
+            from dm_control.mujoco import engine
+            self.camera = engine.MovableCamera(env.sim, *self.render_size)
+            self.camera.set_pose(**camera_pose)
+
+    #The returned frame is overwritten in the next call, copy it to keep it
+    def render(self):
+        if self.camera is not None:
+            img = self.camera.render()
+        else:
+            img = self.env.render(mode='rgb_array') #envs without a mujoco sim
+        if img.shape[:2] == self.size:
+            np.copyto(self.frame, img)
+        else:
+            cv2.resize(img, (self.size[1], self.size[0]), dst=self.frame)
+        return self.frame
+
+class VideoRecorder():
+    """ Encodes frames with ffmpeg as they are added, on a background thread.
+        The queue is bounded so memory stays flat, add_frame blocks if the encoder falls behind """
+    def __init__(self, filename, max_queue_size=32, outputdict={"-pix_fmt": "yuv420p"}):
+        import skvideo.io
+        self.filename = filename
+        self.writer = skvideo.io.FFmpegWriter(filename, outputdict=outputdict)
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self.encode, daemon=True)
+        self.thread.start()
+
+    def encode(self):
+        try:
+            frame = self.queue.get()
+            while frame is not None:
+                self.writer.writeFrame(frame)
+                frame = self.queue.get()
+        except Exception as e:
+            self.error = e
+            #keep consuming so add_frame and close never block
+            while frame is not None:
+                frame = self.queue.get()
+        finally:
+            self.writer.close()
+
+    #Frames are copied, renderers reuse their buffers
+    def add_frame(self, frame):
+        self.queue.put(np.array(frame, dtype=np.uint8))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
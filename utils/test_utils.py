@@ -11,7 +11,7 @@ import sys
 sys.path.append("./relay-policy-learning/adept_envs/")
 import adept_envs
 import utils.constants as constants
-import skvideo.io
+from utils.rendering import FrameRenderer, VideoRecorder
 import argparse
 from tqdm import tqdm
 import keyboard
@@ -58,6 +58,20 @@ def print_img_goals(data_dir="../data/validation/", save_folder = "../data/goals
 
     print("done!")
 
+#Goal images and their vision encoding, every goal file is read and encoded once per model
+class GoalCache():
+    def __init__(self, model):
+        self.model = model
+        self.goals = {}
+
+    def get(self, goal_path):
+        if goal_path not in self.goals:
+            goal = plt.imread(goal_path) #read as RGB, blue shelfs
+            goal = np.rint(goal*255).astype(np.uint8) #change to model scale
+            goal_encoding = self.model.encode_goal(np.expand_dims(goal.transpose(2,0,1), axis=0)) #(1, 64)
+            self.goals[goal_path] = (goal, goal_encoding)
+        return self.goals[goal_path]
+
 #init environment with pos and vel from given file
 def init_env(env, file_name):
     if os.path.getsize(file_name) > 0:   #Check if the file is not empty
@@ -68,23 +82,27 @@ def init_env(env, file_name):
             env.sim.forward()
     return env
 
-#Proxy function to either save or render a model
-def viewer(env, mode='initialize', filename='video', render=False):
-    global render_buffer
-    if mode == 'initialize':
-        render_buffer = []
-        mode = 'render'
+#Proxy to either show the env or stream its frames to a video, one per rollout
+#filename=None does not save a video
+class Viewer():
+    def __init__(self, env, filename=None, show=False, frame_size=(640, 852)):
+        self.env = env
+        self.show = show
+        self.recorder = None
+        if filename is not None:
+            self.renderer = FrameRenderer(env, frame_size, aspect=frame_size[1]/frame_size[0])
+            self.recorder = VideoRecorder(filename)
 
-    if mode == 'render':
-        if render == True:
-            env.render()
-        curr_frame = env.render(mode='rgb_array')
-        curr_frame = cv2.resize(curr_frame , (curr_frame.shape[1]//3 -1, curr_frame.shape[0]//3)) #"852x640"
-        render_buffer.append(curr_frame)
+    def render(self):
+        if self.show:
+            self.env.render()
+        if self.recorder is not None:
+            self.recorder.add_frame(self.renderer.render())
 
-    if mode == 'save':
-        skvideo.io.vwrite(filename, np.asarray(render_buffer), outputdict={"-pix_fmt": "yuv420p"},verbosity=1)
-        print("\n Video saved", filename)
+    def close(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            print("\n Video saved", self.recorder.filename)
 
 #Reproduced saved actions from file in the env. Optionally save a video.
 #Load file should include file path + filename + extension
@@ -105,18 +123,18 @@ def reproduce_file_actions(load_file, save_folder = "../analysis/videos/reproduc
     FPS = 30
     render_skip = max(1, round(1. / \
         (FPS * env.sim.model.opt.timestep * env.frame_skip)))
-    viewer(env, mode='initialize')
+    if(save_video):
+        if not os.path.exists(save_folder):
+                os.makedirs(save_folder)
+    viewer = Viewer(env, save_folder + save_filename if save_video else None, show=show_video)
 
     for i, action in enumerate(data['actions']):
         s , r, _, _ = env.step(action)
         if(i % render_skip == 0):
-            viewer(env, mode='render', render=show_video)
+            viewer.render()
     
     #save_video
-    if(save_video):
-        if not os.path.exists(save_folder):
-                os.makedirs(save_folder)
-        viewer(env, mode='save', filename=save_folder + save_filename)
+    viewer.close()
     env.close()
 
 